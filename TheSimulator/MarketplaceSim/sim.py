@@ -0,0 +1,480 @@
+"""
+In-process revenue engine of the MarketplaceSim simulator.
+
+`RevenueEngine` loads `items.csv` and `prefs.csv` once into arrays and scores a `(users, REC_SIZE)`
+array of recommended item ids with the revenue `Simulation::Execute` (Sim.cpp) computes from
+`recs.csv`, without the file round-trip to the C++ process.
+
+    python sim.py [--items items.csv] [--prefs prefs.csv] [--recs recs.csv] [--expected out.txt]
+
+checks the revenue of the sample files against the one written by the simulator and reports
+the evaluations/sec on the sample and on a synthetic population. `PopulationEvaluator` scores
+`(K, users, REC_SIZE)` candidate recs together over a process pool, and `IncrementalEvaluator`
+re-evaluates only the users whose recs change.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+REC_SIZE = 8
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_csv(path: str, columns: Dict[int, type]) -> pd.DataFrame:
+    """ Headerless csv of the simulator, which may start with a UTF-8 BOM like the sample files """
+    return pd.read_csv(path, header=None, names=list(columns), dtype=columns, encoding='utf-8-sig')
+
+
+def last_unique(keys: np.ndarray):
+    """ Sorted unique `keys` and the position of the last occurrence of each, as repeated map assignments keep """
+    reverse = keys[::-1]
+    uniques, first = np.unique(reverse, return_index=True)
+    return uniques, len(keys) - 1 - first
+
+
+class RevenueEngine:
+    """
+    Revenue of recommendations as `Simulation::Execute`: every user of `prefs.csv` buys the item
+    recommended at position i in the quantity `prefs[user][item][i]` at the item price.
+    Recommended ids missing from `items.csv` are skipped and items without a preference are bought
+    in quantity 0. As in the C++ maps, the last row wins for repeated items, preferences and recs.
+
+    The preferences are a CSR matrix of users by items with `REC_SIZE` quantity columns, stored
+    already multiplied by the prices, and looked up by a sorted `user * num_items + item` key.
+
+    Parameters
+    ----------
+    item_ids: np.ndarray
+        Sorted unique item ids (num_items,).
+    prices: np.ndarray
+        Price of every item (num_items,).
+    user_ids: np.ndarray
+        Sorted unique user ids of the preferences (num_users,), the row order of the recs.
+    indptr: np.ndarray
+        Offsets of the preferences of every user (num_users + 1,).
+    item_rows: np.ndarray
+        Item row of every preference, sorted within each user (nnz,).
+    quantities: np.ndarray
+        Quantity bought at every recommendation position (nnz, REC_SIZE).
+    """
+    def __init__(self, item_ids: np.ndarray, prices: np.ndarray, user_ids: np.ndarray,
+                       indptr: np.ndarray, item_rows: np.ndarray, quantities: np.ndarray):
+        self.item_ids = np.asarray(item_ids, dtype=np.uint64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.user_ids = np.asarray(user_ids, dtype=np.uint64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.item_rows = np.asarray(item_rows, dtype=np.int64)
+        self.quantities = np.asarray(quantities, dtype=np.float64)
+        users = np.repeat(np.arange(self.num_users), np.diff(self.indptr))
+        self.keys = users * self.num_items + self.item_rows
+        if len(self.keys) and (np.diff(self.keys) <= 0).any():
+            raise ValueError("preferences must be sorted by user and item without repeats")
+        # revenue of every preference at every position
+        self.values = self.quantities * self.prices[self.item_rows, None]
+
+    @property
+    def num_items(self) -> int:
+        return len(self.item_ids)
+
+    @property
+    def num_users(self) -> int:
+        return len(self.user_ids)
+
+    @classmethod
+    def from_frames(cls, items: pd.DataFrame, prefs: pd.DataFrame) -> 'RevenueEngine':
+        """
+        Build the arrays from `items` (item_id, price) and `prefs` (user_id, item_id, q_0 ... q_7) rows.
+        Users come from all the preference rows, preferences for unknown items are dropped.
+        """
+        item_ids, last = last_unique(items.iloc[:, 0].to_numpy(np.uint64))
+        prices = items.iloc[:, 1].to_numpy(np.float64)[last]
+
+        pref_users = prefs.iloc[:, 0].to_numpy(np.uint64)
+        pref_items = prefs.iloc[:, 1].to_numpy(np.uint64)
+        quantities = prefs.iloc[:, 2:2 + REC_SIZE].to_numpy(np.float64)
+        user_ids, user_rows = np.unique(pref_users, return_inverse=True)
+        rows = cls.lookup(item_ids, pref_items)
+        known = rows >= 0
+        keys = user_rows[known].astype(np.int64) * len(item_ids) + rows[known]
+        keys, last = last_unique(keys)
+        quantities = quantities[known][last]
+        indptr = np.searchsorted(keys // max(1, len(item_ids)), np.arange(len(user_ids) + 1))
+        return cls(item_ids, prices, user_ids, indptr, keys % max(1, len(item_ids)), quantities)
+
+    @classmethod
+    def from_csv(cls, items_path: str, prefs_path: str) -> 'RevenueEngine':
+        items = read_csv(items_path, {'item_id': np.uint64, 'price': np.float64})
+        prefs = read_csv(prefs_path, {'user_id': np.uint64, 'item_id': np.uint64,
+                                      **{f'q_{i}': np.float64 for i in range(REC_SIZE)}})
+        return cls.from_frames(items, prefs)
+
+    @classmethod
+    def synthetic(cls, num_users: int=100_000, num_items: int=10_000, prefs_per_user: int=20,
+                       seed: int=0) -> 'RevenueEngine':
+        """ Random population with `prefs_per_user` preferences per user, for benchmarks """
+        rng = np.random.default_rng(seed)
+        items = pd.DataFrame({'item_id': np.arange(1, num_items + 1, dtype=np.uint64),
+                              'price': np.round(rng.lognormal(3., 1., num_items), 2)})
+        nnz = num_users * prefs_per_user
+        prefs = pd.DataFrame({'user_id': np.repeat(np.arange(num_users, dtype=np.uint64), prefs_per_user),
+                              'item_id': rng.integers(1, num_items + 1, nnz).astype(np.uint64)})
+        # quantities fall with the position, as buyers look at the first recommendations first
+        quantities = rng.poisson(2., (nnz, REC_SIZE)) * (rng.random((nnz, REC_SIZE)) < 0.8 ** np.arange(REC_SIZE))
+        for i in range(REC_SIZE):
+            prefs[f'q_{i}'] = quantities[:, i].astype(np.float64)
+        return cls.from_frames(items, prefs)
+
+    @staticmethod
+    def lookup(sorted_ids: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """ Position of every id in `sorted_ids`, -1 if missing """
+        ids = np.asarray(ids, dtype=np.uint64)
+        if not len(sorted_ids):
+            return np.full(ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[positions] == ids, positions, -1).astype(np.int64)
+
+    def recs_array(self, recs: pd.DataFrame) -> np.ndarray:
+        """
+        `(num_users, REC_SIZE)` item ids of `recs` (user_id, item_0 ... item_7) rows in the order of `user_ids`.
+        Users without recs get item id 0 everywhere, the default `Execute` reads for them from a fresh simulation.
+        """
+        user_ids, last = last_unique(recs.iloc[:, 0].to_numpy(np.uint64))
+        items = recs.iloc[:, 1:1 + REC_SIZE].to_numpy(np.uint64)[last]
+        array = np.zeros((self.num_users, REC_SIZE), dtype=np.uint64)
+        rows = self.lookup(self.user_ids, user_ids)
+        array[rows[rows >= 0]] = items[rows >= 0]
+        return array
+
+    def read_recs(self, path: str) -> np.ndarray:
+        return self.recs_array(read_csv(path, {'user_id': np.uint64,
+                                               **{f'item_{i}': np.uint64 for i in range(REC_SIZE)}}))
+
+    def user_revenues(self, recs: np.ndarray, users: Optional[np.ndarray]=None) -> np.ndarray:
+        """
+        Revenue of every user for `(..., num_users, REC_SIZE)` recommended item ids, or only of the user
+        rows `users` for `(..., len(users), REC_SIZE)` recs. Leading dimensions are evaluated at once.
+        """
+        recs = np.asarray(recs, dtype=np.uint64)
+        if users is None:
+            users = np.arange(recs.shape[-2])
+        if recs.shape[-1] != REC_SIZE:
+            raise ValueError(f"recs must have {REC_SIZE} items per user, found {recs.shape[-1]}")
+        if not len(self.keys):
+            return np.zeros(recs.shape[:-1])
+        rows = self.lookup(self.item_ids, recs)
+        keys = np.asarray(users, dtype=np.int64)[:, None] * self.num_items + rows
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (rows >= 0) & (self.keys[positions] == keys)
+        return np.where(found, self.values[positions, np.arange(REC_SIZE)], 0.).sum(axis=-1)
+
+    def revenue(self, recs: np.ndarray) -> float:
+        """ Total revenue of `(num_users, REC_SIZE)` recommended item ids, the value of `Simulation::Execute` """
+        recs = np.asarray(recs)
+        if recs.shape[-2] != self.num_users:
+            raise ValueError(f"recs must have one row per user ({self.num_users}), found {recs.shape[-2]}")
+        return float(self.user_revenues(recs).sum())
+
+    def revenues(self, candidates: np.ndarray, users: Optional[np.ndarray]=None,
+                       chunk_size: int=4096) -> np.ndarray:
+        """
+        Revenue (K,) of each of the `(K, num_users, REC_SIZE)` candidate recs, all candidates evaluated
+        together `chunk_size` users at a time. With `users`, candidates only hold the rows of these users
+        and the revenues are the ones of these users alone.
+        """
+        candidates = np.asarray(candidates)
+        if candidates.ndim != 3:
+            raise ValueError(f"candidates must be (K, users, {REC_SIZE}), found {candidates.shape}")
+        if users is None:
+            if candidates.shape[1] != self.num_users:
+                raise ValueError(f"candidates must have one row per user ({self.num_users}), found {candidates.shape[1]}")
+            users = np.arange(self.num_users)
+        totals = np.zeros(candidates.shape[0])
+        for start in range(0, len(users), chunk_size):
+            totals += self.user_revenues(candidates[:, start:start + chunk_size],
+                                         users[start:start + chunk_size]).sum(axis=-1)
+        return totals
+
+
+class IncrementalEvaluator:
+    """
+    Total revenue kept up to date as the recs of a few users change, for policy steps that only touch
+    some users. The revenue of every user is stored, and `update` only evaluates the users of the delta,
+    in time proportional to their number. Revenues of `(user, recs)` pairs already seen are kept in an
+    LRU cache of `cache_size` entries, so users switching back to earlier recs are not evaluated again.
+    
+    Parameters
+    ----------
+    engine: RevenueEngine
+        Items and preferences.
+    recs: np.ndarray, optional
+        Initial `(num_users, REC_SIZE)` recs, item id 0 everywhere without them.
+    cache_size: int
+        Maximum number of memoized `(user, recs)` revenues, 0 disables the cache.
+    """
+    def __init__(self, engine: RevenueEngine, recs: Optional[np.ndarray]=None, cache_size: int=100_000):
+        self.engine = engine
+        self.recs = np.zeros((engine.num_users, REC_SIZE), dtype=np.uint64) if recs is None \
+                    else np.array(recs, dtype=np.uint64)
+        self.user_revenues = engine.user_revenues(self.recs)
+        self.total = float(self.user_revenues.sum())
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def cached(self, key: tuple) -> Optional[float]:
+        revenue = self.cache.get(key)
+        if revenue is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        return revenue
+
+    def memoize(self, key: tuple, revenue: float):
+        if self.cache_size:
+            self.cache[key] = revenue
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def update(self, user_ids: Iterable[int], recs: np.ndarray) -> float:
+        """
+        Replace the recs of `user_ids` by the `(len(user_ids), REC_SIZE)` `recs` and return the new total.
+        Users missing from the preferences are ignored as by `Simulation::Execute`, and the last recs
+        of a user repeated in the delta win.
+        """
+        recs = np.asarray(recs, dtype=np.uint64).reshape(-1, REC_SIZE)
+        rows = self.engine.lookup(self.engine.user_ids, np.asarray(list(user_ids), dtype=np.uint64))
+        if len(rows) != len(recs):
+            raise ValueError(f"{len(rows)} users for {len(recs)} recs")
+        changed = {row: user_recs for row, user_recs in zip(rows.tolist(), recs) if row >= 0}
+        if not changed:
+            return self.total
+
+        rows = np.fromiter(changed, dtype=np.int64, count=len(changed))
+        revenues = np.empty(len(rows))
+        keys = [(row, user_recs.tobytes()) for row, user_recs in changed.items()]
+        missing = []
+        for i, key in enumerate(keys):
+            revenue = self.cached(key)
+            if revenue is None:
+                missing.append(i)
+            else:
+                revenues[i] = revenue
+        if missing:
+            self.misses += len(missing)
+            missing = np.array(missing)
+            revenues[missing] = self.engine.user_revenues(np.stack([changed[row] for row in rows[missing]]),
+                                                          users=rows[missing])
+            for i in missing:
+                self.memoize(keys[i], revenues[i])
+
+        self.total += float((revenues - self.user_revenues[rows]).sum())
+        self.user_revenues[rows] = revenues
+        self.recs[rows] = np.stack(list(changed.values()))
+        return self.total
+
+    def recompute(self) -> float:
+        """ Total of a full evaluation of the current recs, also clearing the rounding of the updates """
+        self.user_revenues = self.engine.user_revenues(self.recs)
+        self.total = float(self.user_revenues.sum())
+        return self.total
+
+
+# engine of the pool workers, inherited from the parent process
+_worker_engine = None
+_worker_buffers = {}
+
+
+def _init_worker(engine: RevenueEngine):
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _shard_revenues(buffer_name: str, shape: tuple, start: int, stop: int, chunk_size: int) -> np.ndarray:
+    """ Revenues of the users `start:stop` of the candidates in the shared memory block `buffer_name` """
+    if buffer_name not in _worker_buffers:
+        # the parent reallocated the block: unmap the old one, only the parent unlinks it
+        for buffer in _worker_buffers.values():
+            buffer.close()
+        _worker_buffers.clear()
+        _worker_buffers[buffer_name] = shared_memory.SharedMemory(name=buffer_name)
+    candidates = np.ndarray(shape, dtype=np.uint64, buffer=_worker_buffers[buffer_name].buf)
+    return _worker_engine.revenues(candidates[:, start:stop], np.arange(start, stop), chunk_size)
+
+
+class PopulationEvaluator:
+    """
+    Revenues of many candidate recommendation sets at once, for policy search scoring a population
+    per iteration. `evaluate` copies the `(K, num_users, REC_SIZE)` candidates into shared memory and
+    every worker of a process pool sums the revenues of one shard of the users for all the candidates,
+    so the work is split over the cores without copying the engine or the candidates per call.
+    
+    Parameters
+    ----------
+    engine: RevenueEngine
+        Items and preferences, inherited by the forked workers.
+    num_workers: int, optional
+        Processes of the pool, defaults to the number of cores. 0 evaluates in this process.
+    chunk_size: int
+        Users evaluated together by a worker, bounding its memory to `K * chunk_size * REC_SIZE` lookups.
+    """
+    def __init__(self, engine: RevenueEngine, num_workers: Optional[int]=None, chunk_size: int=4096):
+        self.engine = engine
+        self.num_workers = (os.cpu_count() or 1) if num_workers is None else num_workers
+        self.chunk_size = chunk_size
+        self.pool = None
+        if self.num_workers:
+            # workers share the tracker of this process, a tracker of their own would unlink the candidates
+            # block when the pool ends
+            resource_tracker.ensure_running()
+            self.pool = mp.get_context('fork').Pool(self.num_workers, initializer=_init_worker, initargs=(engine,))
+        self.buffer = None
+
+    def shards(self):
+        bounds = np.linspace(0, self.engine.num_users, max(1, self.num_workers) + 1).astype(int)
+        return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    def evaluate(self, candidates: np.ndarray) -> np.ndarray:
+        """ Revenue (K,) of each of the `(K, num_users, REC_SIZE)` candidate recs """
+        candidates = np.asarray(candidates, dtype=np.uint64)
+        if candidates.ndim != 3 or candidates.shape[1:] != (self.engine.num_users, REC_SIZE):
+            raise ValueError(f"candidates must be (K, {self.engine.num_users}, {REC_SIZE}), found {candidates.shape}")
+        if self.pool is None:
+            return self.engine.revenues(candidates, chunk_size=self.chunk_size)
+        if self.buffer is None or self.buffer.size < candidates.nbytes:
+            self.release()
+            self.buffer = shared_memory.SharedMemory(create=True, size=max(1, candidates.nbytes))
+        np.ndarray(candidates.shape, dtype=np.uint64, buffer=self.buffer.buf)[:] = candidates
+        tasks = [(self.buffer.name, candidates.shape, start, stop, self.chunk_size) for start, stop in self.shards()]
+        return np.sum(self.pool.starmap(_shard_revenues, tasks), axis=0)
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer.unlink()
+            self.buffer = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def evaluations_per_second(engine: RevenueEngine, recs: np.ndarray, min_time: float=1.) -> float:
+    """ Calls of `engine.revenue(recs)` per second, repeated for at least `min_time` seconds """
+    engine.revenue(recs)
+    num_calls, start = 0, time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        engine.revenue(recs)
+        num_calls += 1
+    return num_calls / (time.perf_counter() - start)
+
+
+def benchmark_incremental(engine: RevenueEngine, num_changed: int=16, num_steps: int=1_000,
+                          repeat_fraction: float=0.5, seed: int=0) -> Dict[str, float]:
+    """
+    Updates/sec of an `IncrementalEvaluator` changing `num_changed` random users per step, where
+    `repeat_fraction` of the updates reuse recs seen before, checked against a full recompute.
+    """
+    rng = np.random.default_rng(seed)
+    evaluator = IncrementalEvaluator(engine, random_recs(engine, seed=seed))
+    # fresh updates are drawn ahead, repeats are taken back from the updates already made
+    rows = rng.integers(0, engine.num_users, (num_steps, num_changed))
+    recs = engine.item_ids[rng.integers(0, engine.num_items, (num_steps, num_changed, REC_SIZE))]
+    repeats = rng.random((num_steps, num_changed)) < repeat_fraction
+    for step in range(1, num_steps):
+        earlier = rng.integers(0, step * num_changed, num_changed)
+        rows[step] = np.where(repeats[step], rows[:step].ravel()[earlier], rows[step])
+        recs[step] = np.where(repeats[step, :, None], recs[:step].reshape(-1, REC_SIZE)[earlier], recs[step])
+    start = time.perf_counter()
+    for step in range(num_steps):
+        evaluator.update(engine.user_ids[rows[step]], recs[step])
+    elapsed = time.perf_counter() - start
+    total = evaluator.total
+    assert np.isclose(total, evaluator.recompute()), "incremental total differs from a full recompute"
+    return {'updates/sec': num_steps / elapsed, 'cache hit rate': evaluator.hits / max(1, evaluator.hits + evaluator.misses)}
+
+
+def random_recs(engine: RevenueEngine, num_candidates: Optional[int]=None, seed: int=0) -> np.ndarray:
+    """ Random `(num_users, REC_SIZE)` recs, or `(num_candidates, num_users, REC_SIZE)` candidates """
+    rng = np.random.default_rng(seed)
+    shape = (engine.num_users, REC_SIZE) if num_candidates is None else (num_candidates, engine.num_users, REC_SIZE)
+    return engine.item_ids[rng.integers(0, engine.num_items, shape)]
+
+
+def benchmark_population(engine: RevenueEngine, num_candidates: int=64, workers: Iterable[int]=(0, 1, 2, 4),
+                         repeats: int=3) -> Dict[int, float]:
+    """ Candidates evaluated per second by a `PopulationEvaluator` of every number of `workers` """
+    candidates = random_recs(engine, num_candidates)
+    expected = None
+    throughputs = {}
+    for num_workers in workers:
+        with PopulationEvaluator(engine, num_workers) as evaluator:
+            revenues = evaluator.evaluate(candidates)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                evaluator.evaluate(candidates)
+            throughputs[num_workers] = num_candidates * repeats / (time.perf_counter() - start)
+        if expected is None:
+            expected = revenues
+        assert np.allclose(revenues, expected), "revenues differ between numbers of workers"
+    return throughputs
+
+
+def main(argv: Optional[Iterable[str]]=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', default=os.path.join(HERE, 'items.csv'))
+    parser.add_argument('--prefs', default=os.path.join(HERE, 'prefs.csv'))
+    parser.add_argument('--recs', default=os.path.join(HERE, 'recs.csv'))
+    parser.add_argument('--expected', default=os.path.join(HERE, 'out.txt'),
+                        help="file whose first line is the revenue of --recs written by the simulator")
+    parser.add_argument('--num-users', type=int, default=100_000, help="users of the synthetic population")
+    parser.add_argument('--num-items', type=int, default=10_000, help="items of the synthetic population")
+    parser.add_argument('--num-candidates', type=int, default=64, help="candidates of the population benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="pool sizes of the population benchmark")
+    args = parser.parse_args(argv)
+
+    engine = RevenueEngine.from_csv(args.items, args.prefs)
+    recs = engine.read_recs(args.recs)
+    revenue = engine.revenue(recs)
+    with open(args.expected) as f:
+        expected = float(f.readline())
+    print(f"revenue {revenue:.10g}, simulator {expected:.10g}")
+    if not np.isclose(revenue, expected, rtol=1e-9, atol=1e-9):
+        raise SystemExit(f"revenue {revenue} differs from the simulator output {expected}")
+    print(f"sample: {evaluations_per_second(engine, recs):,.0f} evaluations/sec")
+
+    population = RevenueEngine.synthetic(num_users=args.num_users, num_items=args.num_items)
+    print(f"synthetic {population.num_users:,} users, {population.num_items:,} items: "
+          f"{evaluations_per_second(population, random_recs(population)):,.1f} evaluations/sec")
+
+    candidates = random_recs(population, num_candidates=8, seed=1)
+    assert np.allclose(population.revenues(candidates), [population.revenue(recs) for recs in candidates])
+    throughputs = benchmark_population(population, args.num_candidates, args.workers)
+    for num_workers, throughput in throughputs.items():
+        print(f"{args.num_candidates} candidates, {num_workers} workers: {throughput:,.1f} candidates/sec "
+              f"({throughput / throughputs[args.workers[0]]:.2f}x)")
+
+    incremental = benchmark_incremental(population)
+    print(f"incremental, 16 users per update: {incremental['updates/sec']:,.0f} updates/sec "
+          f"(full evaluation {evaluations_per_second(population, random_recs(population), min_time=0.2):,.1f}/sec), "
+          f"cache hit rate {incremental['cache hit rate']:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Offline benchmark of every stage of the session transformer on synthetic sessions.
+
+    python benchmarks.py [--num-sessions 10000] [--vocab-size 50000] [--output run.json] [--baseline base.json]
+
+times the padding, batch fetch, feature preprocessing, masking, backbone forward and backward,
+prediction head and ranking metrics with `run_benchmarks`, without the drive or the csv of the
+notebook. Results are written as JSON, and with `--baseline` the median of every stage is compared
+to a previous run, failing when a stage is more than `--tolerance` slower.
+"""
+
+import argparse
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from ecommerce_transformer_lib import compare_benchmarks, git_revision, run_benchmarks
+
+
+def main(argv: Optional[Iterable[str]]=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--num-sessions', type=int, default=10_000)
+    parser.add_argument('--max-seq-len', type=int, default=20)
+    parser.add_argument('--mean-seq-len', type=float, default=5.)
+    parser.add_argument('--vocab-size', type=int, default=50_000)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--hidden-dim', type=int, default=64)
+    parser.add_argument('--n-layer', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=20, help="timed calls of every stage")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON file of the results, named after the git revision by default")
+    parser.add_argument('--label', default=None, help="name of the run stored with the results")
+    parser.add_argument('--baseline', default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="slowdown of a stage counted as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(num_sessions=args.num_sessions, max_seq_len=args.max_seq_len,
+                             mean_seq_len=args.mean_seq_len, vocab_size=args.vocab_size,
+                             batch_size=args.batch_size, hidden_dim=args.hidden_dim, n_layer=args.n_layer,
+                             steps=args.steps, seed=args.seed, label=args.label,
+                             output_path=args.output or f'benchmark_results/{git_revision() or "run"}.json')
+    print(pd.DataFrame(results['stages']).T.to_string())
+    if args.baseline:
+        comparison = compare_benchmarks(args.baseline, results, tolerance=args.tolerance)
+        print(comparison.to_string())
+        if comparison.regression.any():
+            raise SystemExit(f"regressions in {', '.join(comparison.index[comparison.regression])}")
+
+
+if __name__ == '__main__':
+    main()
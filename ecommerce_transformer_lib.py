@@ -0,0 +1,3555 @@
+"""
+Data pipeline, model, training and benchmark code of the `ecommerce_transformer.py` notebook.
+
+Importing it has no side effects: no drive is mounted, no data is read and nothing is trained,
+so the notebook and `benchmarks.py` share the same code.
+"""
+
+import os
+import json
+
+from ast import literal_eval
+from glob import glob
+from tqdm import tqdm
+from typing import Dict, List, Union, Optional, Any, Iterable
+from datetime import datetime
+
+import random as rd
+import math as m
+import numpy as np 
+import pandas as pd 
+
+"""#Load Data"""
+
+columns = ['user_session', 'user_id', 'item_ids', 'num_items', 'category_ids',
+           'session_initial_time', 'session_initial_timestamp', 'session_weekday_sin', 'session_weekday_cos', 'session_recency', 'session_actions',
+           'brand_ids', 'prices', 'relative_prices', 'day_index',]
+
+def clean_list(arrays: list or str):
+    if isinstance(arrays, str):
+        arrays = arrays.replace("nan, ", "0, ")
+        arrays = arrays.replace(", nan", ", 0")
+        arrays = literal_eval(arrays)
+    else:
+        arrays = [0 if not i else i for i in arrays]
+    return arrays
+
+list_cols = ['category_ids', 'brand_ids', 'item_ids', 'prices', 'relative_prices',
+             'session_weekday_sin', 'session_weekday_cos', 'session_recency', 'session_actions']
+list_dtypes = {'category_ids': np.int64, 'brand_ids': np.int64, 'item_ids': np.int64, 'session_actions': np.int64}
+
+"""##Columnar ragged arrays"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _list_cell_to_str(cell) -> str:
+    if isinstance(cell, str):
+        return cell
+    if isinstance(cell, float) and np.isnan(cell):
+        return '[]'
+    return '[' + ', '.join(str(i) for i in clean_list(cell)) + ']'
+
+
+def parse_integers(joined: str, dtype=np.int64) -> np.ndarray:
+    """
+    Exact parse of comma separated integers, also accepting integral floats written as `12.0`.
+    Ids are never parsed through float64, which would round those beyond 2**53.
+    """
+    tokens = pd.Series(joined.split(','), dtype=object).str.strip().str.replace(r'\.0*$', '', regex=True)
+    malformed = ~tokens.str.fullmatch(r'[+-]?\d+')
+    if malformed.any():
+        raise ValueError(f"Non-integer values in an integer list column, e.g. {tokens[malformed].iloc[0]!r}")
+    return np.array([int(token) for token in tokens], dtype=dtype)
+
+
+def parse_list_column(cells: Iterable, dtype=np.float64):
+    """
+    Parse a column of stringified lists into a flat value array plus per-row offsets,
+    so that row `i` owns `values[offsets[i]:offsets[i+1]]`.
+    The whole column is joined into a single string and parsed by one `np.fromstring` call,
+    `nan` entries become 0 as in `clean_list`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        values of `dtype` and int64 offsets of length `len(cells) + 1`
+    """
+    bodies = pd.Series([_list_cell_to_str(cell) for cell in cells], dtype=object).str.strip().str[1:-1]
+    lengths = np.where(bodies.str.strip() == '', 0, bodies.str.count(',') + 1).astype(np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    joined = ','.join(bodies[lengths > 0]).replace('nan', '0')
+    try:
+        with warnings.catch_warnings():
+            # a partially read string is only reported with a warning
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(joined, dtype=dtype, sep=',')
+    except (DeprecationWarning, ValueError):
+        if not np.issubdtype(dtype, np.integer):
+            raise
+        values = parse_integers(joined, dtype)
+    if len(values) != offsets[-1]:
+        raise ValueError(f"Parsed {len(values)} values, expected {offsets[-1]}: malformed list cells")
+    return values, offsets
+
+
+def _parse_list_chunk(args):
+    cells, dtype = args
+    return parse_list_column(cells, dtype)
+
+
+def parse_list_columns(df: pd.DataFrame, list_cols: list, dtypes: Dict[str, Any] = None,
+                       num_workers: Optional[int] = None, chunk_size: int = 100_000):
+    """
+    Parse the list-valued columns of `df` into `{col: (values, offsets)}`,
+    spreading row chunks of every column over `num_workers` processes (all cores by default).
+    """
+    dtypes = dtypes or {}
+    num_workers = num_workers or os.cpu_count() or 1
+    tasks, owners = [], []
+    for col in list_cols:
+        cells = df[col].values
+        for start in range(0, max(len(cells), 1), chunk_size):
+            tasks.append((cells[start:start + chunk_size], dtypes.get(col, np.float64)))
+            owners.append(col)
+
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(tasks))) as executor:
+            parsed = list(executor.map(_parse_list_chunk, tasks))
+    else:
+        parsed = [_parse_list_chunk(task) for task in tasks]
+
+    ragged = {}
+    for col in list_cols:
+        chunks = [chunk for owner, chunk in zip(owners, parsed) if owner == col]
+        values = np.concatenate([chunk_values for chunk_values, _ in chunks])
+        offsets, shift = [np.zeros(1, dtype=np.int64)], 0
+        for chunk_values, chunk_offsets in chunks:
+            offsets.append(chunk_offsets[1:] + shift)
+            shift += len(chunk_values)
+        ragged[col] = (values, np.concatenate(offsets))
+    return ragged
+
+
+def ragged_to_cells(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """ Object array of per-row views into `values` (no copies) """
+    cells = np.empty(len(offsets) - 1, dtype=object)
+    for i, cell in enumerate(np.split(values, offsets[1:-1])):
+        cells[i] = cell
+    return cells
+
+
+def to_ragged(cells: Iterable):
+    """ Inverse of `ragged_to_cells`: flat values and offsets from a column of lists/arrays """
+    cells = list(cells)
+    lengths = np.fromiter(map(len, cells), dtype=np.int64, count=len(cells))
+    offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.concatenate([np.asarray(cell).ravel() for cell in cells]) if offsets[-1] else np.zeros(0)
+    return values, offsets
+
+
+def source_stat(source: str) -> dict:
+    return {'path': source, 'size': os.path.getsize(source), 'mtime': os.path.getmtime(source)}
+
+
+def save_columnar_cache(cache_dir: str, frame: pd.DataFrame, ragged: Dict[str, tuple], source: str = None):
+    """
+    Save the scalar columns of `frame` and the ragged list columns as plain `.npy` files,
+    so that they can be memory-mapped on load.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    scalar_cols = [col for col in frame.columns if col not in ragged]
+    for col in scalar_cols:
+        values = frame[col].values
+        np.save(os.path.join(cache_dir, f'{col}.npy'), values.astype(str) if values.dtype == object else values)
+    for col, (values, offsets) in ragged.items():
+        np.save(os.path.join(cache_dir, f'{col}.values.npy'), values)
+        np.save(os.path.join(cache_dir, f'{col}.offsets.npy'), offsets)
+    meta = {'columns': list(frame.columns), 'list_cols': list(ragged), 'num_rows': len(frame)}
+    if source is not None:
+        meta['source'] = source_stat(source)
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def load_columnar_cache(cache_dir: str, mmap_mode: Optional[str] = None, source: str = None):
+    """
+    Load a cache written by `save_columnar_cache`.
+    Returns None if there is no cache or it is older than the `source` csv.
+    """
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if source is not None and os.path.exists(source):
+        if meta.get('source') != source_stat(source):
+            return None
+    frame = pd.DataFrame({col: np.load(os.path.join(cache_dir, f'{col}.npy'), mmap_mode=mmap_mode)
+                          for col in meta['columns'] if col not in meta['list_cols']})
+    ragged = {col: (np.load(os.path.join(cache_dir, f'{col}.values.npy'), mmap_mode=mmap_mode),
+                    np.load(os.path.join(cache_dir, f'{col}.offsets.npy'), mmap_mode=mmap_mode))
+              for col in meta['list_cols']}
+    return frame, ragged, meta['columns']
+
+
+def load_sessions(path: str, columns: list, list_cols: list, dtypes: Dict[str, Any] = None,
+                  cache_dir: Optional[str] = None, num_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Read the sessions csv, parsing list columns with `parse_list_columns` instead of `clean_list`.
+    With `cache_dir` the parsed columns are stored once and later runs skip the csv entirely.
+    List cells of the returned frame are numpy views into the flat value arrays.
+    """
+    cached = load_columnar_cache(cache_dir, source=path) if cache_dir else None
+    if cached is None:
+        frame = pd.read_csv(path)
+        frame.columns = columns
+        ragged = parse_list_columns(frame, list_cols, dtypes, num_workers=num_workers)
+        if cache_dir:
+            save_columnar_cache(cache_dir, frame, ragged, source=path)
+        frame = frame.drop(columns=list_cols)
+    else:
+        frame, ragged, columns = cached
+    for col, (values, offsets) in ragged.items():
+        frame[col] = ragged_to_cells(values, offsets)
+    return frame[columns]
+
+"""#Scheme"""
+
+class NpEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        if isinstance(obj, np.floating):
+            return float(obj)
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return super(NpEncoder, self).default(obj)
+
+
+class ItemVocabulary:
+    """
+    Dense remap of raw item ids to embedding rows, so that the item embedding table and
+    the tied output layer are sized by the catalogue instead of by the largest product id.
+    Row 0 is padding (raw id 0), the next rows are either one out-of-vocabulary bucket or
+    `num_hash_buckets` buckets that unknown ids are hashed into, and the kept ids follow in sorted order.
+    
+    Parameters
+    ----------
+    ids: np.ndarray
+        Sorted raw ids kept in the vocabulary.
+    num_hash_buckets: int
+        Number of hash buckets for unknown ids, 0 maps all of them to a single OOV row.
+    """
+    PADDING = 0
+    OOV = 1
+    HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+    def __init__(self, ids: np.ndarray, num_hash_buckets: int=0):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.num_hash_buckets = num_hash_buckets
+        self.first_row = 1 + max(1, num_hash_buckets)
+
+    @classmethod
+    def from_counts(cls, ids: np.ndarray, counts: np.ndarray, min_count: int=1,
+                         max_size: Optional[int]=None, num_hash_buckets: int=0):
+        """ Keep ids seen at least `min_count` times, at most the `max_size` most frequent ones """
+        keep = (counts >= min_count) & (ids != cls.PADDING)
+        ids, counts = ids[keep], counts[keep]
+        if max_size is not None and len(ids) > max_size:
+            ids = ids[np.argsort(-counts, kind='stable')[:max_size]]
+        return cls(np.sort(ids), num_hash_buckets=num_hash_buckets)
+
+    @classmethod
+    def fit(cls, values: np.ndarray, **kwargs):
+        ids, counts = np.unique(values, return_counts=True)
+        return cls.from_counts(ids, counts, **kwargs)
+
+    def __len__(self):
+        """ Number of embedding rows """
+        return self.first_row + len(self.ids)
+
+    def encode(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, values), max(len(self.ids) - 1, 0))
+        found = self.ids[positions] == values if len(self.ids) else np.zeros(values.shape, dtype=bool)
+        if self.num_hash_buckets:
+            hashed = (values.astype(np.uint64) * self.HASH_MULTIPLIER) >> np.uint64(32)
+            unknown = 1 + (hashed % np.uint64(self.num_hash_buckets)).astype(np.int64)
+        else:
+            unknown = self.OOV
+        rows = np.where(found, positions + self.first_row, unknown)
+        rows[values == self.PADDING] = self.PADDING
+        return rows
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        """ Raw ids of embedding rows, padding and OOV/hash rows give 0 """
+        rows = np.asarray(rows)
+        recommendable = rows >= self.first_row
+        return np.where(recommendable, self.ids[np.where(recommendable, rows - self.first_row, 0)], 0) \
+               if len(self.ids) else np.zeros(rows.shape, dtype=np.int64)
+
+    def save(self, path: str, feat: str):
+        np.save(os.path.join(path, f'items.{feat}.npy'), self.ids)
+        with open(os.path.join(path, f'items.{feat}.json'), 'w') as f:
+            json.dump({'num_hash_buckets': self.num_hash_buckets}, f)
+
+    @classmethod
+    def load(cls, path: str, feat: str):
+        with open(os.path.join(path, f'items.{feat}.json')) as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(path, f'items.{feat}.npy')), **meta)
+
+
+class SchemaBuilder:
+    """
+    Streaming schema statistics. Every `update` folds a chunk of flat feature values into
+    running min/max, plus the sorted unique values of the categorical features, so the data is scanned
+    once whatever its size and the state of the continuous features stays constant.
+    Features in `encoded_feats` are label encoded by their sorted unique values
+    (the same codes as `LabelEncoder`), and their statistics are the ones of the codes.
+    
+    Parameters
+    ----------
+    cat_feats: list
+        Categorical features, cast to int.
+    num_feats: list
+        Numerical features, cast to float.
+    encoded_feats: list
+        Features replaced by their vocabulary index.
+    item_feats: Dict[str, dict]
+        Features remapped by an `ItemVocabulary`, with the keyword arguments of `ItemVocabulary.from_counts`.
+    """
+    def __init__(self, cat_feats: list, num_feats: list, encoded_feats: Iterable[str]=('category_ids',),
+                       item_feats: Optional[Dict[str, dict]]=None):
+        self.types = {**{feat: 'categorical' for feat in cat_feats}, **{feat: 'numerical' for feat in num_feats}}
+        self.encoded_feats = list(encoded_feats)
+        self.item_feats = item_feats or {}
+        self.min_vals, self.max_vals = {}, {}
+        self.uniques = {feat: np.zeros(0, dtype=np.int64) for feat, feat_type in self.types.items()
+                        if feat_type == 'categorical'}
+        self.counts = {feat: np.zeros(0, dtype=np.int64) for feat in self.item_feats}
+
+    def dtype(self, feat: str):
+        return np.int64 if self.types[feat] == 'categorical' else np.float64
+
+    def update(self, chunk: Dict[str, np.ndarray]):
+        for feat, values in chunk.items():
+            values = np.asarray(values, dtype=self.dtype(feat))
+            if not len(values):
+                continue
+            self.min_vals[feat] = min(self.min_vals.get(feat, values.min()), values.min())
+            self.max_vals[feat] = max(self.max_vals.get(feat, values.max()), values.max())
+            if feat in self.item_feats:
+                uniques, counts = np.unique(values, return_counts=True)
+                self.uniques[feat], inverse = np.unique(np.concatenate([self.uniques[feat], uniques]), return_inverse=True)
+                self.counts[feat] = np.bincount(inverse, weights=np.concatenate([self.counts[feat], counts])).astype(np.int64)
+            elif feat in self.uniques:
+                self.uniques[feat] = np.union1d(self.uniques[feat], values)
+
+    def update_frame(self, df: pd.DataFrame):
+        self.update({feat: to_ragged(df[feat].values)[0] for feat in self.types})
+
+    def build(self):
+        """
+        Returns
+        -------
+        Tuple[dict, Dict[str, Union[np.ndarray, ItemVocabulary]]]
+            schema and the vocabularies of the encoded features
+        """
+        schema, vocabularies = {}, {}
+        for feat, feat_type in self.types.items():
+            # the distinct values of continuous features are not tracked
+            cardinality = len(self.uniques[feat]) if feat in self.uniques else None
+            if feat in self.item_feats:
+                vocabularies[feat] = ItemVocabulary.from_counts(self.uniques[feat], self.counts[feat], **self.item_feats[feat])
+                min_val, max_val, cardinality = 0, len(vocabularies[feat]) - 1, len(vocabularies[feat].ids)
+            elif feat in self.encoded_feats:
+                vocabularies[feat] = self.uniques[feat]
+                min_val, max_val = 0, len(self.uniques[feat]) - 1
+            else:
+                min_val, max_val = self.min_vals[feat], self.max_vals[feat]
+            # remapped item features keep the width of the raw id range they had before the vocabulary
+            dim_val = self.max_vals[feat] if feat in self.item_feats else max_val
+            schema[feat] = {'type': feat_type,
+                            'min_val': min_val,
+                            'max_val': max_val,
+                        'cardinality': cardinality,
+                      'embedding_dim': int(np.log(dim_val)) if dim_val > 0 else 0,}
+        return schema, vocabularies
+
+
+def save_schema(path: str, schema: dict, vocabularies: Dict[str, Union[np.ndarray, ItemVocabulary]],
+                source: Optional[str] = None):
+    """ Write the schema and vocabularies, recording the size and mtime of the `source` csv they were built from """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'schema.json'), 'w') as f:
+        json.dump(schema, f, cls=NpEncoder, indent=4)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'source': source_stat(source) if source is not None else None}, f, indent=4)
+    for feat, vocabulary in vocabularies.items():
+        if isinstance(vocabulary, ItemVocabulary):
+            vocabulary.save(path, feat)
+        else:
+            np.save(os.path.join(path, f'vocab.{feat}.npy'), vocabulary)
+
+
+def load_schema(path: str, source: Optional[str] = None):
+    """
+    Load a schema written by `save_schema`.
+    Returns None if there is none or it was built from another version of the `source` csv.
+    """
+    if not os.path.exists(os.path.join(path, 'schema.json')):
+        return None
+    if source is not None and os.path.exists(source):
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            if json.load(f).get('source') != source_stat(source):
+                return None
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    vocabularies = {os.path.basename(file)[len('vocab.'):-len('.npy')]: np.load(file)
+                    for file in glob(os.path.join(path, 'vocab.*.npy'))}
+    for file in glob(os.path.join(path, 'items.*.json')):
+        feat = os.path.basename(file)[len('items.'):-len('.json')]
+        vocabularies[feat] = ItemVocabulary.load(path, feat)
+    return schema, vocabularies
+
+
+def encode_values(vocabulary: Union[np.ndarray, ItemVocabulary], values: np.ndarray, feat: str='') -> np.ndarray:
+    """ Index of `values` in the sorted `vocabulary`, as `LabelEncoder.transform`, or the rows of an `ItemVocabulary` """
+    if isinstance(vocabulary, ItemVocabulary):
+        return vocabulary.encode(values)
+    encoded = np.searchsorted(vocabulary, values)
+    if len(values) and (encoded.max() >= len(vocabulary) or (vocabulary[encoded] != values).any()):
+        raise ValueError(f"{feat} contains values unseen by its vocabulary")
+    return encoded
+
+
+def apply_schema(df: pd.DataFrame, schema: dict, vocabularies: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """ Cast every feature to its schema type and encode the vocabulary features, one flat array per feature """
+    for feat, stats in schema.items():
+        values, offsets = to_ragged(df[feat].values)
+        values = values.astype(np.int64 if stats['type'] == 'categorical' else np.float64)
+        if feat in vocabularies:
+            values = encode_values(vocabularies[feat], values, feat)
+        df[feat] = ragged_to_cells(values, offsets)
+    return df
+
+cat_feats = ["item_ids", "brand_ids", "category_ids", "session_actions"]
+num_feats = ["prices", "relative_prices", 
+             "session_weekday_sin", "session_weekday_cos", "session_recency"]
+
+"""#Model"""
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+
+from collections import Counter, OrderedDict
+
+import contextlib
+import copy
+import queue
+import re
+import threading
+import time
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+"""##Dataset"""
+
+def left_pad(values: np.ndarray, offsets: np.ndarray, max_seq_len: int, dtype=None) -> np.ndarray:
+    """
+    Scatter ragged rows into a zero `(num_rows, max_seq_len)` array in one pass, aligning every row to the right.
+    Rows longer than `max_seq_len` keep their last `max_seq_len` values.
+    """
+    lengths = np.diff(offsets)
+    num_rows = len(lengths)
+    padded = np.zeros((num_rows, max_seq_len), dtype=dtype or values.dtype)
+    kept = np.minimum(lengths, max_seq_len)
+    rows = np.repeat(np.arange(num_rows), kept)
+    # position of every kept value inside its row, counted from the end of the sequence
+    from_end = np.arange(kept.sum()) - np.repeat(np.cumsum(kept) - kept, kept)
+    padded[rows, max_seq_len - kept[rows] + from_end] = values[offsets[1:][rows] - kept[rows] + from_end]
+    return padded
+
+
+class PaddedTensorStore:
+    """
+    Contiguous `(num_sessions, max_seq_len)` array per feature, left padded with zeros.
+    Categorical features are stored as int32 and numerical ones as float16,
+    i.e. with the dtypes of the batch tensors.
+    
+    Parameters
+    ----------
+    arrays: Dict[str, np.ndarray]
+        Padded array of every feature.
+    lengths: np.ndarray
+        Number of non-padded positions of every session.
+    index: pd.Index
+        Session keys, the (user_id, user_session, session_initial_timestamp) index of the source frame.
+    """
+    DTYPES = {'categorical': np.int32, 'numerical': np.float16}
+
+    def __init__(self, arrays: Dict[str, np.ndarray], lengths: np.ndarray, index: pd.Index):
+        self.arrays = arrays
+        self.lengths = lengths
+        self.index = index
+        self.features = list(arrays)
+        self.max_seq_len = next(iter(arrays.values())).shape[1]
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, schema: dict, max_seq_len: int=20):
+        arrays, lengths = {}, None
+        for feat in df.columns:
+            values, offsets = to_ragged(df[feat].values)
+            dtype = cls.DTYPES[schema[feat]['type']]
+            if dtype == np.int32 and len(values) and (values.max() > np.iinfo(np.int32).max or values.min() < 0):
+                raise ValueError(f"{feat} does not fit int32, encode it before padding")
+            arrays[feat] = left_pad(values, offsets, max_seq_len, dtype=dtype)
+            lengths = np.minimum(np.diff(offsets), max_seq_len)
+        return cls(arrays, lengths, df.index)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for feat, array in self.arrays.items():
+            np.save(os.path.join(path, f'{feat}.npy'), array)
+        np.save(os.path.join(path, 'lengths.npy'), self.lengths)
+        index = self.index.to_frame(index=False)
+        for level in index.columns:
+            values = index[level].values
+            np.save(os.path.join(path, f'index.{level}.npy'), values.astype(str) if values.dtype == object else values)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'features': self.features, 'index': list(index.columns),
+                       'max_seq_len': self.max_seq_len}, f, indent=4)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = 'r'):
+        """ Memory-map a saved store, processes loading the same path share the page cache """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {feat: np.load(os.path.join(path, f'{feat}.npy'), mmap_mode=mmap_mode) for feat in meta['features']}
+        lengths = np.load(os.path.join(path, 'lengths.npy'))
+        index = pd.MultiIndex.from_arrays([np.load(os.path.join(path, f'index.{level}.npy')) for level in meta['index']],
+                                          names=meta['index'])
+        return cls(arrays, lengths, index)
+
+    @classmethod
+    def exists(cls, path: Optional[str]) -> bool:
+        return path is not None and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+class BucketBatchSampler:
+    """
+    Batches of sessions with similar lengths, each trimmed to its own longest session.
+    Sessions are ordered by length (ties broken at random) and cut into batches,
+    `shuffle` redraws the ties and randomizes the order in which the batches are visited.
+    
+    Parameters
+    ----------
+    lengths: np.ndarray
+        Number of non-padded positions of every session.
+    batch_size: int
+        Maximum number of sessions in a batch.
+    max_seq_len: int
+        Padded length of the sessions.
+    """
+    def __init__(self, lengths: np.ndarray, batch_size: int, max_seq_len: int):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_seq_len = max_seq_len
+        self.starts = np.arange(0, len(self.lengths), batch_size)
+        self.arrange(np.argsort(self.lengths, kind='stable'), np.arange(len(self.starts)))
+
+    def arrange(self, order: np.ndarray, batch_order: np.ndarray):
+        self.order = order
+        self.batch_order = batch_order
+        self.seq_lens = np.maximum.reduceat(self.lengths[order], self.starts) if len(order) else np.zeros(0, dtype=int)
+
+    def shuffle(self):
+        rng = np.random.default_rng(rd.getrandbits(64))
+        order = np.lexsort((rng.random(len(self.lengths)), self.lengths))
+        self.arrange(order, rng.permutation(len(self.starts)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, batch_id: int):
+        """ Positions of the sessions in batch `batch_id` and the length they are trimmed to """
+        start = self.starts[self.batch_order[batch_id]]
+        return self.order[start:start + self.batch_size], int(self.seq_lens[self.batch_order[batch_id]])
+
+    def __iter__(self):
+        for batch_id in range(len(self)):
+            yield self[batch_id]
+
+    @property
+    def padding_eliminated(self) -> float:
+        """ Fraction of the padded positions of full-length batches that trimming removes """
+        sizes = np.diff(np.append(self.starts, len(self.lengths)))
+        padding_full = len(self.lengths) * self.max_seq_len - self.lengths.sum()
+        padding_trimmed = (sizes * self.seq_lens).sum() - self.lengths.sum()
+        return float(1 - padding_trimmed / padding_full) if padding_full else 0.
+
+
+def random_position(candidates: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """ Uniformly drawn column of a True entry of every row of a boolean matrix, -1 for rows without any """
+    scores = np.where(candidates, rng.random(candidates.shape), -1.)
+    return np.where(candidates.any(axis=1), scores.argmax(axis=1), -1)
+
+
+class MLMBatchMasker:
+    """
+    Masked language modeling schema and targets of whole batches, drawn with NumPy in the data pipeline
+    instead of in the model forward. It follows `MaskedLanguageModeling` in training mode: items are masked
+    with probability `mlm_probability` and sessions of two or more items keep at least one masked
+    and one visible item.
+    The generator of a batch is seeded by `(seed, epoch, batch_id)`, so masks do not depend on which
+    worker draws them.
+    
+    Parameters
+    ----------
+    mlm_probability: float
+        Probability of an item to be masked.
+    padding_idx: int
+        Padding item id.
+    seed: int
+        Base seed.
+    item_feat: str
+        Item id feature.
+    """
+    def __init__(self, mlm_probability: float=0.15, padding_idx: int=0, seed: int=0, item_feat: str='item_ids'):
+        self.mlm_probability = mlm_probability
+        self.padding_idx = padding_idx
+        self.seed = seed
+        self.item_feat = item_feat
+
+    def __call__(self, item_ids: np.ndarray, epoch: int, batch_id: int) -> Dict[str, np.ndarray]:
+        rng = np.random.default_rng((self.seed, epoch, batch_id))
+        rows = np.arange(len(item_ids))
+        non_padded = item_ids != self.padding_idx
+        mask_labels = (rng.random(item_ids.shape) < self.mlm_probability) & non_padded
+
+        # at least one masked item per session
+        forced = random_position(non_padded, rng)
+        has_items = forced >= 0
+        mask_labels[rows[has_items], forced[has_items]] = True
+
+        # sessions with only masked items get one of them back
+        only_labels = mask_labels.sum(axis=1) == non_padded.sum(axis=1)
+        unmasked = random_position(mask_labels, rng)
+        unmask = only_labels & (unmasked >= 0)
+        mask_labels[rows[unmask], unmasked[unmask]] = False
+
+        labels = np.where(mask_labels, item_ids, self.padding_idx).astype(item_ids.dtype)
+        return {'mask_schema': mask_labels, 'masked_targets': labels}
+
+
+class TabularSequentialDataset(Dataset):
+
+    def __init__(self, df: pd.DataFrame, schema: dict, max_seq_len: int=20, batch_size: int=16,
+                       store_path: Optional[str]=None, device: torch.device=device,
+                       masker: Optional[MLMBatchMasker]=None):
+        self.schema = schema
+        self.store = self.build_store(df, max_seq_len, store_path)
+        self.indices = np.arange(len(self.store))
+        self.batch_size = batch_size
+        self.num_batches = int(m.ceil(len(self.store) / batch_size))
+        self.max_seq_len = max_seq_len
+        self.device = device
+        self.pin_memory = self.device.type == 'cuda'
+        self.sampler = None
+        # masking drawn with the batches, seeded per epoch
+        self.masker = masker
+        self.epoch = 0
+        # distributed shard, see `shard`
+        self.rank = 0
+        self.world_size = 1
+        self.drop_uneven = True
+        self._buffers = None
+        self._transfer_done = None
+
+    def build_store(self, df: pd.DataFrame, max_seq_len: int, store_path: Optional[str]=None):
+        """ Pad `df` into a `PaddedTensorStore`, or memory-map the one saved at `store_path` """
+        if PaddedTensorStore.exists(store_path):
+            return PaddedTensorStore.load(store_path)
+        store = PaddedTensorStore.from_frame(df, self.schema, max_seq_len)
+        if store_path is not None:
+            store.save(store_path)
+            store = PaddedTensorStore.load(store_path)
+        return store
+
+    @property
+    def dataset(self) -> PaddedTensorStore:
+        """ Padded sessions, the store the batches are gathered from """
+        return self.store
+
+    def __len__(self):
+        if self.drop_uneven:
+            # every rank gets the same number of batches, the last incomplete round is dropped
+            return self.num_batches // self.world_size
+        return len(range(self.rank, self.num_batches, self.world_size))
+
+    def shard(self, rank: int, world_size: int, drop_uneven: bool=True):
+        """
+        Keep the batches `rank, rank + world_size, ...` of the shuffled order. Ranks must shuffle with
+        the same seed so that their shards do not overlap.
+        With `drop_uneven` the batches of the last incomplete round are dropped, as training needs
+        the same number of steps on every rank. Without it every batch is kept, e.g. for evaluation.
+        """
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_uneven = drop_uneven
+
+    def global_batch_id(self, batch_id: int) -> int:
+        return batch_id * self.world_size + self.rank
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+    
+    def shuffle(self):
+        if self.sampler is not None:
+            self.sampler.shuffle()
+        else:
+            np.random.default_rng(rd.getrandbits(64)).shuffle(self.indices)
+
+    def order_state(self) -> Dict[str, np.ndarray]:
+        """ Batch order drawn by the last `shuffle`, to resume an epoch in the same order """
+        if self.sampler is not None:
+            return {'order': self.sampler.order.copy(), 'batch_order': self.sampler.batch_order.copy()}
+        return {'indices': self.indices.copy()}
+
+    def load_order_state(self, state: Dict[str, np.ndarray]):
+        if self.sampler is not None:
+            self.sampler.arrange(state['order'], state['batch_order'])
+        else:
+            self.indices = state['indices'].copy()
+
+    def bucket_by_length(self) -> BucketBatchSampler:
+        """ Switch to length-bucketed batches trimmed to their longest session """
+        self.sampler = BucketBatchSampler(self.store.lengths, self.batch_size, self.max_seq_len)
+        self.num_batches = len(self.sampler)
+        return self.sampler
+
+    def batch_positions(self, batch_id: int):
+        """ Positions of the sessions in batch `batch_id` and the sequence length of the batch """
+        if not 0 <= batch_id < len(self):
+            raise IndexError(f"batch {batch_id} out of range for {len(self)} batches")
+        batch_id = self.global_batch_id(batch_id)
+        if self.sampler is not None:
+            return self.sampler[batch_id]
+        return self.indices[batch_id*self.batch_size:(batch_id+1)*self.batch_size], self.max_seq_len
+
+    def allocate_buffers(self, pin_memory: bool=False) -> Dict[str, torch.Tensor]:
+        """ Host tensors holding one full batch of every feature """
+        buffers = dict()
+        for feat, array in self.store.arrays.items():
+            buffer = torch.from_numpy(np.empty((self.batch_size,) + array.shape[1:], dtype=array.dtype))
+            buffers[feat] = buffer.pin_memory() if pin_memory else buffer
+        return buffers
+
+    def gather(self, positions: np.ndarray, out: Optional[Dict[str, torch.Tensor]]=None,
+                     seq_len: Optional[int]=None) -> Dict[str, torch.Tensor]:
+        """
+        Take the rows at integer `positions` of every feature array, keeping their last `seq_len` steps.
+        With `out` the rows are written into the front of its buffers and views of them are returned,
+        otherwise every feature gets a freshly allocated tensor.
+        """
+        seq_len = seq_len or self.max_seq_len
+        tensors = dict()
+        for feat, array in self.store.arrays.items():
+            array = array[:, array.shape[1] - seq_len:]
+            if out is None:
+                tensors[feat] = torch.from_numpy(np.take(array, positions, axis=0))
+            else:
+                tensor = out[feat].view(-1)[:len(positions) * seq_len].view(len(positions), seq_len)
+                np.take(array, positions, axis=0, out=tensor.numpy())
+                tensors[feat] = tensor
+        return tensors
+
+    def add_masking(self, batch_id: int, tensors: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """ Add the `mask_schema` and `masked_targets` of the masker to host batch tensors """
+        if self.masker is not None:
+            masking = self.masker(tensors[self.masker.item_feat].numpy(), self.epoch, self.global_batch_id(batch_id))
+            tensors.update({name: torch.from_numpy(array) for name, array in masking.items()})
+        return tensors
+
+    def __getitem__(self, batch_id: int):
+        positions, seq_len = self.batch_positions(batch_id)
+        if self.device.type == 'cpu':
+            return self.add_masking(batch_id, self.gather(positions, seq_len=seq_len))
+
+        # reuse one pinned buffer, waiting for the previous copy out of it to finish
+        if self._buffers is None:
+            self._buffers = self.allocate_buffers(pin_memory=self.pin_memory)
+        if self._transfer_done is not None:
+            self._transfer_done.synchronize()
+        tensors = self.add_masking(batch_id, self.gather(positions, out=self._buffers, seq_len=seq_len))
+        tensors = {feat: tensor.to(self.device, non_blocking=True) for feat, tensor in tensors.items()}
+        self._transfer_done = torch.cuda.Event()
+        self._transfer_done.record()
+        return tensors
+
+    def worker_view(self):
+        """
+        Copy of the dataset for `DataLoader` workers: batches stay on the host in freshly
+        allocated tensors, pinning and the device transfer are left to the loader and `batch_to_device`.
+        """
+        view = copy.copy(self)
+        view.device = torch.device('cpu')
+        view.pin_memory = False
+        view._buffers = view._transfer_done = None
+        return view
+
+    def loader(self, num_workers: int=4, prefetch_factor: int=2, worker_init_fn=None,
+                     start: int=0) -> DataLoader:
+        """
+        Multi-process loader yielding whole batches in the current `indices` order, from batch `start` on.
+        Workers are forked per epoch, so call `shuffle()` and `set_epoch()` before iterating.
+        """
+        view = self.worker_view()
+        # the worker base seed is drawn from a generator of the epoch, not from the global one,
+        # so that starting a loader mid-epoch leaves the torch generator where a full epoch has it
+        return DataLoader(view, batch_size=None, shuffle=False, sampler=range(start, len(view)),
+                          num_workers=num_workers,
+                          prefetch_factor=prefetch_factor if num_workers else None,
+                          pin_memory=self.pin_memory,
+                          worker_init_fn=worker_init_fn,
+                          generator=torch.Generator().manual_seed(self.epoch))
+
+
+def batch_to_device(tensors: Dict[str, torch.Tensor], device: torch.device=device) -> Dict[str, torch.Tensor]:
+    return {feat: tensor.to(device, non_blocking=True) for feat, tensor in tensors.items()}
+
+
+class BatchPrefetcher:
+    """
+    Iterate the batches of a `TabularSequentialDataset` while a background thread prepares the
+    next `depth` ones: rows are gathered into a ring of reusable (pinned on GPU hosts) buffers and,
+    on GPU, copied to the device on a side stream.
+    A yielded batch stays valid until the next one is requested.
+    
+    Parameters
+    ----------
+    dataset: TabularSequentialDataset
+        Dataset to iterate, in its current `indices` order.
+    depth: int
+        Number of batches prepared ahead of the consumer.
+    """
+    def __init__(self, dataset: TabularSequentialDataset, depth: int=1):
+        self.dataset = dataset
+        self.depth = depth
+        self.device = dataset.device
+        self.slots = [dataset.allocate_buffers(pin_memory=dataset.pin_memory) for _ in range(depth + 1)]
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        # end of the last non-blocking copy out of every slot
+        self.copy_done = [None] * len(self.slots)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _produce(self, free: queue.Queue, ready: queue.Queue, stop: threading.Event):
+        try:
+            for batch_id in range(len(self.dataset)):
+                slot = free.get()
+                if stop.is_set():
+                    return
+                # the consumer releases a slot before the copy out of it has necessarily run
+                if self.copy_done[slot] is not None:
+                    self.copy_done[slot].synchronize()
+                positions, seq_len = self.dataset.batch_positions(batch_id)
+                tensors = self.dataset.add_masking(batch_id,
+                                                   self.dataset.gather(positions, out=self.slots[slot], seq_len=seq_len))
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        tensors = batch_to_device(tensors, self.device)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    self.copy_done[slot] = event
+                ready.put((slot, tensors, event))
+        except Exception as error:
+            ready.put((None, error, None))
+        ready.put(None)
+
+    def __iter__(self):
+        free, ready, stop = queue.Queue(), queue.Queue(), threading.Event()
+        for slot in range(len(self.slots)):
+            free.put(slot)
+        producer = threading.Thread(target=self._produce, args=(free, ready, stop), daemon=True)
+        producer.start()
+        held = None
+        try:
+            while True:
+                item = ready.get()
+                if held is not None:
+                    free.put(held)
+                    held = None
+                if item is None:
+                    break
+                slot, tensors, event = item
+                if slot is None:
+                    raise tensors
+                if event is not None:
+                    torch.cuda.current_stream().wait_event(event)
+                    for tensor in tensors.values():
+                        tensor.record_stream(torch.cuda.current_stream())
+                held = slot
+                yield tensors
+        finally:
+            stop.set()
+            for slot in range(len(self.slots)):
+                free.put(slot)
+            producer.join()
+
+class StreamingSessionDataset(IterableDataset):
+    """
+    Padded session batches streamed from disk, for data that does not fit in memory.
+    Sessions are read in chunks from the raw csv or from a columnar cache written by `load_sessions`,
+    encoded and padded per chunk, and shuffled through a bounded buffer.
+    Chunks are sharded round-robin over distributed ranks and DataLoader workers,
+    so memory stays at about `chunk_size + shuffle_buffer` sessions per worker.
+    
+    Parameters
+    ----------
+    path: str
+        Sessions csv, or a columnar cache directory.
+    schema: dict
+        Feature schema, its features are the ones yielded.
+    encoders: Dict[str, np.ndarray]
+        Vocabularies of the label encoded features, as built by `SchemaBuilder`.
+    max_seq_len: int
+        Padded length, longer sessions are skipped like by the `num_items` filter.
+    batch_size: int
+        Number of sessions in a batch.
+    chunk_size: int
+        Number of sessions read at a time.
+    shuffle_buffer: int
+        Number of sessions kept for shuffling, 0 disables shuffling.
+    columns: list
+        Names of the csv columns.
+    seed: int
+        Base seed, combined with the epoch and the shard id.
+    """
+    def __init__(self, path: str, schema: dict, encoders: Optional[Dict[str, np.ndarray]]=None,
+                       max_seq_len: int=20, batch_size: int=16, chunk_size: int=10_000,
+                       shuffle_buffer: int=50_000, columns: list=columns, seed: int=0):
+        super().__init__()
+        self.path = path
+        self.schema = schema
+        self.features = list(schema)
+        self.encoders = encoders or {}
+        self.max_seq_len = max_seq_len
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.columns = columns
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def shard(self):
+        """ Id of this shard and the number of shards over ranks and workers """
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def read_chunks(self, shard_id: int, num_shards: int):
+        """ Yield `{feat: (values, offsets)}` for the chunks of this shard """
+        if os.path.isdir(self.path):
+            _, ragged, _ = load_columnar_cache(self.path, mmap_mode='r')
+            num_rows = len(ragged[self.features[0]][1]) - 1
+            for chunk_id, start in enumerate(range(0, num_rows, self.chunk_size)):
+                if chunk_id % num_shards != shard_id:
+                    continue
+                end = min(start + self.chunk_size, num_rows)
+                chunk = {}
+                for feat in self.features:
+                    values, offsets = ragged[feat]
+                    chunk[feat] = (np.asarray(values[offsets[start]:offsets[end]]),
+                                   np.asarray(offsets[start:end + 1]) - offsets[start])
+                yield chunk
+        else:
+            for chunk_id, frame in enumerate(pd.read_csv(self.path, chunksize=self.chunk_size)):
+                if chunk_id % num_shards != shard_id:
+                    continue
+                frame.columns = self.columns
+                yield {feat: parse_list_column(frame[feat].values, list_dtypes.get(feat, np.float64))
+                       for feat in self.features}
+
+    def encode(self, chunk: Dict[str, tuple]) -> Dict[str, np.ndarray]:
+        """ Apply the schema encodings and pad a chunk, dropping sessions longer than `max_seq_len` """
+        lengths = np.diff(chunk[self.features[0]][1])
+        keep = (lengths > 0) & (lengths <= self.max_seq_len)
+        padded = {}
+        for feat in self.features:
+            values, offsets = chunk[feat]
+            if feat in self.encoders:
+                values = encode_values(self.encoders[feat], values, feat)
+            array = left_pad(values, offsets, self.max_seq_len,
+                             dtype=PaddedTensorStore.DTYPES[self.schema[feat]['type']])
+            padded[feat] = array[keep]
+        return padded
+
+    def __iter__(self):
+        shard_id, num_shards = self.shard()
+        rng = np.random.default_rng((self.seed, self.epoch, shard_id))
+        pool = {feat: np.zeros((0, self.max_seq_len), dtype=PaddedTensorStore.DTYPES[stats['type']])
+                for feat, stats in self.schema.items()}
+
+        for chunk in self.read_chunks(shard_id, num_shards):
+            chunk = self.encode(chunk)
+            pool = {feat: np.concatenate([pool[feat], chunk[feat]]) for feat in self.features}
+            # emit whole batches only, the rest of the pool waits for the next chunk
+            num_ready = len(pool[self.features[0]]) - self.shuffle_buffer
+            num_ready -= num_ready % self.batch_size
+            if num_ready <= 0:
+                continue
+            order = self.pool_order(rng, len(pool[self.features[0]]))
+            yield from self.batches({feat: array[order[:num_ready]] for feat, array in pool.items()})
+            pool = {feat: array[order[num_ready:]] for feat, array in pool.items()}
+
+        order = self.pool_order(rng, len(pool[self.features[0]]))
+        yield from self.batches({feat: array[order] for feat, array in pool.items()})
+
+    def pool_order(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        return rng.permutation(size) if self.shuffle_buffer else np.arange(size)
+
+    def batches(self, arrays: Dict[str, np.ndarray]):
+        for start in range(0, len(arrays[self.features[0]]), self.batch_size):
+            yield {feat: torch.from_numpy(np.ascontiguousarray(array[start:start + self.batch_size]))
+                   for feat, array in arrays.items()}
+
+"""##Feature preprocessing"""
+
+class EmbeddingTableView:
+    """ `nn.Embedding`-like access to the rows of one feature of a `FusedEmbeddingTable` """
+    def __init__(self, table, feat: str):
+        self.table = table
+        self.feat = feat
+        self.num_embeddings = table.num_embeddings[feat]
+        self.embedding_dim = table.embedding_dims[feat]
+
+    @property
+    def weight(self) -> torch.Tensor:
+        start = self.table.offsets[self.feat]
+        return self.table.weight[start:start + self.num_embeddings * self.embedding_dim] \
+                   .view(self.num_embeddings, self.embedding_dim)
+
+    def __call__(self, indices: torch.Tensor) -> torch.Tensor:
+        return F.embedding(indices, self.weight)
+
+
+class FusedEmbeddingTable(nn.Module):
+    """
+    Embedding tables of several categorical features packed into one flat parameter.
+    Feature `f` owns `num_embeddings[f] * embedding_dims[f]` consecutive values starting at `offsets[f]`,
+    so every output column of a lookup is an address `offset + index * dim + column` and
+    the concatenated embeddings of all features come out of a single gather.
+    
+    Parameters
+    ----------
+    num_embeddings: Dict[str, int]
+        Number of rows of every feature.
+    embedding_dims: Dict[str, int]
+        Embedding dimension of every feature.
+    """
+    def __init__(self, num_embeddings: Dict[str, int], embedding_dims: Dict[str, int]):
+        super(FusedEmbeddingTable, self).__init__()
+        self.features = list(num_embeddings)
+        self.num_embeddings = dict(num_embeddings)
+        self.embedding_dims = dict(embedding_dims)
+        self.offsets, total = {}, 0
+        column_feature, column_stride, column_base = [], [], []
+        for i, feat in enumerate(self.features):
+            dim = self.embedding_dims[feat]
+            self.offsets[feat] = total
+            column_feature += [i] * dim
+            column_stride += [dim] * dim
+            column_base += [total + j for j in range(dim)]
+            total += self.num_embeddings[feat] * dim
+        self.embedding_dim = len(column_feature)
+        self.weight = nn.Parameter(torch.empty(total))
+        nn.init.normal_(self.weight)
+        self.register_buffer('column_feature', torch.tensor(column_feature, dtype=torch.long), persistent=False)
+        self.register_buffer('column_stride', torch.tensor(column_stride, dtype=torch.long), persistent=False)
+        self.register_buffer('column_base', torch.tensor(column_base, dtype=torch.long), persistent=False)
+
+    def forward(self, indices: torch.Tensor) -> torch.Tensor:
+        """ indices: (..., num_features) row of every feature -> (..., embedding_dim) """
+        addresses = indices.long().index_select(-1, self.column_feature) * self.column_stride + self.column_base
+        return torch.take(self.weight, addresses)
+
+    def views(self) -> Dict[str, EmbeddingTableView]:
+        return {feat: EmbeddingTableView(self, feat) for feat in self.features}
+
+
+class FeaturePreprocessing(nn.Module):
+    
+    def __init__(self, schema: Dict[str, str], hidden_dim: int=64, training: bool=True, fused: bool=False):
+        super(FeaturePreprocessing, self).__init__()
+        self.training = training
+        self.fused = fused
+        # registered submodules, or views of the fused table
+        self.embedding = nn.ModuleDict() if not fused else dict()
+        self.hidden_dim = hidden_dim
+        self.features_dim = 0
+        self.features_order = list()
+        for feat, stats in schema.items():
+            if stats['type'] == 'categorical':
+                if not fused:
+                    self.embedding[feat] = nn.Embedding(num_embeddings=stats['max_val']+1, 
+                                                         embedding_dim=stats['embedding_dim'])
+                self.features_dim += stats['embedding_dim']
+            else:
+                self.features_dim += 1
+            self.features_order.append(feat)
+        if fused:
+            # categorical features first, then numerical ones
+            self.cat_order = [feat for feat in self.features_order if schema[feat]['type'] == 'categorical']
+            self.num_order = [feat for feat in self.features_order if schema[feat]['type'] != 'categorical']
+            self.fused_table = FusedEmbeddingTable({feat: schema[feat]['max_val']+1 for feat in self.cat_order},
+                                                   {feat: schema[feat]['embedding_dim'] for feat in self.cat_order})
+            self.embedding.update(self.fused_table.views())
+        self.normalize = nn.BatchNorm1d(num_features=self.features_dim)
+        self.regularize = nn.Dropout(p=0.1369)
+        self.full_connect = nn.Linear(in_features=self.features_dim, 
+                                     out_features=self.hidden_dim, bias=True)
+        self.activation = nn.Mish()
+            
+    def forward(self, tensors: Dict[str, torch.Tensor]):
+        if self.fused:
+            return self.forward_fused(tensors)
+        features = []
+        for feat in self.features_order:
+            if feat in self.embedding.keys():
+                feat_tensor = self.embedding[feat](tensors[feat])
+                feat_tensor = torch.swapaxes(feat_tensor, axis0=1, axis1=2)
+            else:
+                feat_tensor = torch.unsqueeze(tensors[feat], dim=1)
+            features.append(feat_tensor)
+        features = torch.cat(features, dim=1)
+        features = self.normalize(features) # shape: (B, Df, L)
+        features = torch.swapaxes(features, axis0=1, axis1=2)
+        features = self.regularize(features) # shape: (B, L, Df)
+        features = self.full_connect(features) # shape: (B, L, Dh)
+        features = self.activation(features) 
+        return features
+
+    def forward_fused(self, tensors: Dict[str, torch.Tensor]):
+        batch_size, seq_len = tensors[self.features_order[0]].shape
+        embedding_dim = self.fused_table.embedding_dim
+        features = torch.empty((batch_size, seq_len, self.features_dim), 
+                               dtype=self.fused_table.weight.dtype, device=self.fused_table.weight.device)
+        features[..., :embedding_dim] = self.fused_table(torch.stack([tensors[feat] for feat in self.cat_order], dim=-1))
+        if self.num_order:
+            features[..., embedding_dim:] = torch.stack([tensors[feat] for feat in self.num_order], dim=-1)
+        # BatchNorm1d over (B*L, Df) rows has the statistics of the (B, Df, L) layout
+        features = self.normalize(features.view(-1, self.features_dim)).view(batch_size, seq_len, -1)
+        features = self.regularize(features) # shape: (B, L, Df)
+        features = self.full_connect(features) # shape: (B, L, Dh)
+        features = self.activation(features) 
+        return features
+
+
+def benchmark_feature_preprocessing(schema: dict, batch: Dict[str, torch.Tensor], hidden_dim: int=64,
+                                    steps: int=50, warmup: int=5) -> Dict[str, float]:
+    """ Mean forward+backward time in ms of the per-feature and the fused embedding paths on `batch` """
+    timings = {}
+    for fused in (False, True):
+        model = FeaturePreprocessing(schema, hidden_dim=hidden_dim, fused=fused).to(next(iter(batch.values())).device)
+        for step in range(warmup + steps):
+            if step == warmup:
+                start = time.perf_counter()
+            model(batch).sum().backward()
+        timings['fused' if fused else 'per_feature'] = (time.perf_counter() - start) / steps * 1e3
+    return timings
+
+"""#Sequence Masking"""
+
+from dataclasses import dataclass
+
+@dataclass
+class MaskingInfo:
+    schema: torch.Tensor
+    targets: torch.Tensor
+
+    @classmethod
+    def from_batch(cls, batch: Dict[str, torch.Tensor]) -> Optional["MaskingInfo"]:
+        """ Masking precomputed by the data pipeline (see `MLMBatchMasker`), None if the batch has none """
+        if 'mask_schema' not in batch:
+            return None
+        return cls(batch['mask_schema'].bool(), batch['masked_targets'])
+        
+        
+class MaskSequence(nn.Module):
+    """
+    Base class to prepare masked items inputs/labels for language modeling tasks.
+    
+    Transformer architectures can be trained in different ways. Depending of the training method,
+    there is a specific masking schema. The masking schema sets the items to be predicted (labels)
+    and mask (hide) their positions in the sequence so that they are not used by the Transformer
+    layers for prediction.
+    We currently provide 4 different masking schemes out of the box:
+        - Causal LM (clm)
+        - Masked LM (mlm)
+        - Permutation LM (plm)
+        - Replacement Token Detection (rtd)
+    This class can be extended to add different a masking scheme.
+    
+    Parameters
+    ----------
+    hidden_size:
+        The hidden dimension of input tensors, needed to initialize trainable vector of
+        masked positions.
+    pad_token: int, default = 0
+        Index of the padding token used for getting batch of sequences with the same length
+    """
+    def __init__(self, hidden_size: int,
+                       padding_idx: int = 0,
+            eval_on_last_item_only: bool = True, **kwargs):
+        super(MaskSequence, self).__init__()
+        self.padding_idx = padding_idx
+        self.hidden_size = hidden_size
+        self.eval_on_last_item_only = eval_on_last_item_only
+        self.mask_schema: Optional[torch.Tensor] = None
+        self.masked_targets: Optional[torch.Tensor] = None
+
+        # Create a trainable embedding to replace masked interactions
+        self.masked_item_embedding = nn.Parameter(torch.Tensor(self.hidden_size))
+        torch.nn.init.normal_(self.masked_item_embedding, mean=0, std=.001)
+    def compute_masked_targets(self, item_ids: torch.Tensor, training=False) -> MaskingInfo:
+        """
+        Method to prepare masked labels based on the sequence of item ids.
+        It returns the true labels of masked positions and the related boolean mask.
+        And the attributes of the class `mask_schema` and `masked_targets` are updated to be re-used in other modules.
+        
+        Parameters
+        ----------
+        item_ids: torch.Tensor
+            The sequence of input item ids used for deriving labels of next item prediction task.
+        training: bool
+            Flag to indicate whether we are in `Training` mode or not.
+            During training, the labels can be any items within the sequence based on the selected masking task.
+            During evaluation, we are predicting the last item in the sequence.
+        
+        Returns
+        -------
+        Tuple[MaskingSchema, MaskedTargets]
+        """
+        assert item_ids.ndim == 2, "`item_ids` must have 2 dimensions."
+        return self.use_masking_info(self._compute_masked_targets(item_ids, training=training), item_ids)
+
+    def use_masking_info(self, masking_info: MaskingInfo, item_ids: torch.Tensor) -> MaskingInfo:
+        """ Make `masking_info` the current mask schema and targets, read by the other modules """
+        self.mask_schema, self.masked_targets = masking_info.schema, masking_info.targets
+        return masking_info
+    def apply_mask_to_inputs(self, inputs: torch.Tensor, schema: torch.Tensor) -> torch.Tensor:
+        """
+        Control the masked positions in the inputs by replacing the true interaction
+        by a learnable masked embedding.
+        
+        Parameters
+        ----------
+        inputs: torch.Tensor
+            The 3-D tensor of interaction embeddings resulting from the ops: TabularFeatures + aggregation + projection(optional)
+        schema: MaskingSchema
+            The boolean mask indicating masked positions.
+        """
+        inputs = torch.where(schema.unsqueeze(-1).bool(),
+                             self.masked_item_embedding.to(inputs.dtype),
+                             inputs)
+        return inputs
+    def predict_all(self, item_ids: torch.Tensor) -> MaskingInfo:
+        """
+        Prepare labels for all next item predictions instead of last-item predictions 
+                in a user's sequence.
+            
+        Returns
+        -------
+        Tuple[MaskingSchema, MaskedTargets]
+        """
+        # shift sequence of item-ids
+        labels = item_ids[:, 1:]
+        
+        # As after shifting the sequence length will be subtracted by one, adding a masked item in
+        # the sequence to return to the initial sequence.
+        labels = torch.cat([labels,
+                            torch.zeros((labels.shape[0], 1), dtype=labels.dtype).to(item_ids.device)], axis=-1)
+        
+        # apply mask on input where target is on padding index
+        mask_labels = labels != self.padding_idx
+        return MaskingInfo(mask_labels, labels)
+    def forward(self, inputs: torch.Tensor, item_ids: torch.Tensor, training: bool=False,
+                      masking_info: Optional[MaskingInfo]=None) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        inputs: torch.Tensor 3D
+            Interaction embeddings from: TabularFeatures + aggregation + projection(optional)
+        item_ids: torch.Tensor
+            Sequence of input item ids used for deriving labels of next item prediction task.
+        training: bool
+            Draw training masks instead of masking the last item.
+        masking_info: MaskingInfo, optional
+            Mask schema and targets precomputed with the batch, used instead of drawing new ones.
+        """
+        if masking_info is not None:
+            mask_info = self.use_masking_info(masking_info, item_ids)
+        else:
+            mask_info = self.compute_masked_targets(item_ids=item_ids, training=training)
+        if mask_info.schema is None:
+            raise ValueError("`mask_schema must be set.`")
+        return self.apply_mask_to_inputs(inputs, mask_info.schema)
+
+    def append_masked_position(self, inputs: torch.Tensor, item_ids: torch.Tensor):
+        """
+        Inference inputs for the item following the sessions: the oldest step is dropped and the masked
+        embedding is appended as the last position. Returns the inputs and their attention mask.
+        """
+        masked = self.masked_item_embedding.to(inputs.dtype).expand(inputs.shape[0], 1, -1)
+        attention_mask = torch.cat([item_ids[:, 1:] != self.padding_idx,
+                                    torch.ones_like(item_ids[:, :1], dtype=torch.bool)], dim=1)
+        return torch.cat([inputs[:, 1:], masked], dim=1), attention_mask.to(inputs.dtype)
+
+    def forward_output_size(self, input_size):
+        return input_size
+
+    def attention_mask(self, item_ids: torch.Tensor) -> torch.Tensor:
+        """ Attention mask of a batch leaving its padded positions out, passed to the backbone with it """
+        return (item_ids != self.padding_idx).float()
+
+    def transformer_required_arguments(self) -> Dict[str, Any]:
+        # the padding attention mask belongs to a batch, it is given to the backbone call explicitly
+        return {"attention_mask": None}
+
+    def transformer_optional_arguments(self) -> Dict[str, Any]:
+        return {}
+        
+    @property
+    def transformer_arguments(self) -> Dict[str, Any]:
+        """
+        Prepare additional arguments to pass to the Transformer forward methods.
+        """
+        return {**self.transformer_required_arguments(), 
+                **self.transformer_optional_arguments()}
+
+class MaskedLanguageModeling(MaskSequence):
+    """
+    In Masked Language Modeling (mlm) you randomly select some positions of the sequence to be predicted, which are masked.
+    During training, the Transformer layer is allowed to use positions on the right (future info).
+    During inference, all past items are visible for the Transformer layer, which tries to predict the next item.
+    
+    Parameters
+    ----------
+    {mask_sequence_parameters}
+    mlm_probability: Optional[float], default = 0.15
+        Probability of an item to be selected (masked) as a label of the given sequence.
+        p.s. We enforce that at least one item is masked for each sequence, so that the network can
+        learn something with it.
+    """
+
+    def __init__(self, hidden_size: int,
+                       padding_idx: int = 0,
+                   mlm_probability: float = 0.15,
+            eval_on_last_item_only: bool = True, **kwargs):
+        super(MaskedLanguageModeling, self).__init__(hidden_size=hidden_size,
+                                                     padding_idx=padding_idx,
+                                          eval_on_last_item_only=eval_on_last_item_only,
+                                                          kwargs=kwargs)
+        self.mlm_probability = mlm_probability
+    def _compute_masked_targets(self, item_ids: torch.Tensor, training=False) -> MaskingInfo:
+        """
+        Prepare sequence with mask schema for masked language modeling prediction
+        the function is based on HuggingFace's transformers/data/data_collator.py
+        
+        Parameters
+        ----------
+        item_ids: torch.Tensor
+            Sequence of input itemid (target) column
+        
+        Returns
+        -------
+        labels: torch.Tensor
+            Sequence of masked item ids.
+        mask_labels: torch.Tensor
+            Masking schema for masked targets positions.
+        """
+
+        labels = torch.full(item_ids.shape, self.padding_idx, dtype=item_ids.dtype, device=item_ids.device)
+        non_padded_mask = item_ids != self.padding_idx
+
+        rows_ids = torch.arange(item_ids.size(0), dtype=torch.long, device=item_ids.device)
+        
+        # During training, masks labels to be predicted according to a probability, 
+        #     ensuring that each session has at least 1 label to predict
+        if training:
+            # Selects a percentage of items to be masked (selected as labels)
+            probability_matrix = torch.full(item_ids.shape, self.mlm_probability, device=item_ids.device)
+            mask_labels = torch.bernoulli(probability_matrix).bool() & non_padded_mask
+            labels = torch.where(mask_labels, item_ids, torch.full_like(item_ids, self.padding_idx))
+
+            # Set at least 1 item in the sequence to mask
+            random_index_by_session = torch.multinomial(non_padded_mask.float(), num_samples=1).squeeze()
+            labels[rows_ids, random_index_by_session] = item_ids[rows_ids, random_index_by_session]
+            mask_labels = labels != self.padding_idx
+
+            # If a sequence has only masked labels, unmasks 1 of the labels
+            sequences_with_only_labels = mask_labels.sum(dim=1) == non_padded_mask.sum(dim=1)
+            sampled_labels_to_unmask = torch.multinomial(mask_labels.float(), num_samples=1).squeeze()
+
+            labels_to_unmask = torch.masked_select(sampled_labels_to_unmask, sequences_with_only_labels)
+            rows_to_unmask = torch.masked_select(rows_ids, sequences_with_only_labels)
+
+            labels[rows_to_unmask, labels_to_unmask] = self.padding_idx
+            mask_labels = labels != self.padding_idx
+
+        else:
+            if self.eval_on_last_item_only:
+                # last non-padded position, sessions being left padded
+                last_item_sessions = item_ids.shape[1] - 1 - torch.argmax(non_padded_mask.flip(1).int(), dim=1)
+                labels[rows_ids, last_item_sessions] = item_ids[rows_ids, last_item_sessions]
+                mask_labels = labels != self.padding_idx
+            else:
+                masking_info = self.predict_all(item_ids)
+                mask_labels, labels = masking_info.schema, masking_info.targets
+
+        return MaskingInfo(mask_labels, labels)
+
+def generate_square_subsequent_mask(dim):
+    mask = (torch.triu(torch.ones(dim, dim))==1).transpose(0, 1)
+    mask = mask.float().masked_fill(mask==0, float('-inf'))\
+                       .masked_fill(mask==1, float(0.))
+    return mask
+
+
+"""##Sequence Processing"""
+
+
+import inspect
+import transformers
+
+
+class XLNetConfig(transformers.XLNetConfig):
+    @classmethod
+    def build(cls, d_model,
+                   n_head,
+                   n_layer,
+            total_seq_length=None,
+                   attn_type="bi",
+                  hidden_act="gelu",
+           initializer_range=0.01,
+              layer_norm_eps=0.03,
+                     dropout=0.3,
+                   pad_token=0,
+       log_attention_weights=False,
+                     mem_len=1, **kwargs):
+        return cls(d_model=d_model,
+                   d_inner=d_model * 4,
+                   n_layer=n_layer,
+                    n_head=n_head,
+                 attn_type=attn_type,
+             ff_activation=hidden_act,
+         initializer_range=initializer_range,
+            layer_norm_eps=layer_norm_eps,
+                   dropout=dropout,
+              pad_token_id=pad_token,
+         output_attentions=log_attention_weights,
+                vocab_size=1,
+                   mem_len=mem_len,
+                   **kwargs)
+    
+    
+class GPT2Prepare(nn.Module):
+    # keys of the arguments built by `forward`
+    transformer_arguments = ("inputs_embeds", "head_mask")
+    
+    def __init__(self, transformer, masking):
+        super().__init__()
+        self.transformer = transformer
+        self.masking = masking
+        # uint8 head masks keyed by (seq_len, device)
+        self.head_masks = dict()
+
+    def head_mask(self, seq_len: int, device: torch.device) -> torch.Tensor:
+        key = (seq_len, device)
+        if key not in self.head_masks:
+            # head_mask has shape n_layer x batch x n_heads x N x N
+            self.head_masks[key] = torch.tril(
+                torch.ones((seq_len, seq_len), dtype=torch.uint8, device=device)
+            ).view(1, 1, 1, seq_len, seq_len).repeat(self.transformer.config.num_hidden_layers, 1, 1, 1, 1)
+        return self.head_masks[key]
+
+    def forward(self, inputs_embeds) -> Dict[str, Any]:
+        return {"inputs_embeds": inputs_embeds, 
+                    "head_mask": self.head_mask(inputs_embeds.shape[1], inputs_embeds.device)}
+
+    
+class TransformerBlock(nn.Module):
+    """
+    Sequence block running a HuggingFace transformer on the interaction embeddings.
+    
+    Parameters
+    ----------
+    transformer: transformers.PretrainedConfig
+        Config of the transformer to build.
+    masking: MaskSequence, optional
+        Masking block whose `transformer_arguments` are bound at construction. The padding attention mask of a
+        batch (`masking.attention_mask(item_ids)`) is given to `forward` as `attention_mask`.
+        An XLNet config with `attn_type="uni"` builds a causal block: HF XLNet cannot add a padding mask
+        to its own causal mask for batches of several sessions, so the model is built bidirectional and
+        both masks are passed as its `perm_mask` (see `mask_arguments`).
+    prepare_module: type, optional
+        Module class building the transformer arguments from the inputs, e.g. `GPT2Prepare`, with
+        their keys listed in its `transformer_arguments`.
+    output_fn: Callable
+        Extracts the hidden states from the transformer outputs.
+    packed: bool
+        With an attention mask, sort the sessions by length and run the transformer on `num_buckets`
+        groups, each trimmed to its longest session. Sessions must be left padded.
+    num_buckets: int
+        Number of length groups of the packed path.
+    """
+
+    def __init__(self, transformer,
+                       masking=None,
+                prepare_module=None, 
+                     output_fn=lambda model_outputs: model_outputs[0],
+                        packed: bool=False,
+                   num_buckets: int=4,):
+        super().__init__()
+
+        self.causal = getattr(transformer, 'attn_type', None) == 'uni'
+        if self.causal:
+            transformer = copy.deepcopy(transformer)
+            transformer.attn_type = 'bi'
+        model_cls = transformers.MODEL_MAPPING[transformer.__class__]
+        self.transformer = model_cls(transformer)
+        # arguments of the transformer forward, bound once
+        self.forward_params = frozenset(inspect.signature(self.transformer.forward).parameters)
+
+        if masking is not None:
+            required = list(masking.transformer_required_arguments().keys())
+            check = all(param in self.forward_params for param in required)
+            if not check:
+                raise ValueError(f"{masking.__class__.__name__} requires the parameters: "
+                                 f"{', '.join(required)} in the {type(self.transformer)} signature")
+
+        self.masking = masking
+        self.prepare_module = prepare_module(self.transformer, masking) if prepare_module else None
+        self.output_fn = output_fn
+        self.packed = packed
+        self.num_buckets = num_buckets
+        # arguments forwarded to the transformer, resolved once against its signature:
+        # the keys of the prepared inputs, the fixed masking arguments, and whether the padding mask is taken
+        self.prepare_arguments = tuple(param for param in self.prepare_module.transformer_arguments
+                                       if param in self.forward_params) if self.prepare_module else ()
+        self.fixed_arguments = {param: value for param, value in masking.transformer_arguments.items()
+                                if value is not None and param in self.forward_params} if masking else {}
+        self.takes_attention_mask = self.causal or "attention_mask" in self.forward_params
+
+    def forward(self, inputs_embeds, attention_mask=None):
+        if attention_mask is not None and attention_mask.shape != inputs_embeds.shape[:2]:
+            raise ValueError(f"attention_mask of shape {tuple(attention_mask.shape)} does not match "
+                             f"the inputs {tuple(inputs_embeds.shape[:2])}")
+        if self.packed and attention_mask is not None and self.prepare_module is None:
+            return self.forward_packed(inputs_embeds, attention_mask)
+
+        if self.prepare_module is not None:
+            prepared = self.prepare_module(inputs_embeds)
+            transformer_kwargs = {param: prepared[param] for param in self.prepare_arguments}
+        else:
+            transformer_kwargs = {"inputs_embeds": inputs_embeds}
+        transformer_kwargs.update(self.fixed_arguments)
+        if self.takes_attention_mask:
+            transformer_kwargs.update(self.mask_arguments(inputs_embeds, attention_mask))
+        outputs = self.transformer(**transformer_kwargs)
+        outputs = self.output_fn(outputs)
+        return outputs
+
+    def forward_packed(self, inputs_embeds: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Run the sessions in groups of similar lengths, each trimmed to its longest session.
+        Outputs of the trimmed padded positions are zeros.
+        """
+        batch_size, seq_len, _ = inputs_embeds.shape
+        lengths = attention_mask.sum(dim=1).long()
+        order = torch.argsort(lengths)
+        sorted_lengths = lengths[order].tolist()
+        outputs = inputs_embeds.new_zeros((batch_size, seq_len, self.transformer.config.hidden_size))
+        end = 0
+        for group in order.chunk(self.num_buckets):
+            end += len(group)
+            # groups are sorted by length, their last session is the longest
+            window = slice(seq_len - max(sorted_lengths[end - 1], 1), seq_len)
+            outputs[group, window] = self.output_fn(self.transformer(
+                inputs_embeds=inputs_embeds[group, window],
+                **self.mask_arguments(inputs_embeds[group, window], attention_mask[group, window])))
+        return outputs
+
+    def mask_arguments(self, inputs_embeds: torch.Tensor, attention_mask: Optional[torch.Tensor]=None) -> Dict[str, torch.Tensor]:
+        """
+        Masking arguments of the transformer: the padding `attention_mask` as is, or for a causal block a
+        `(B, N, N)` XLNet `perm_mask` hiding from every position the later ones and the padded ones.
+        """
+        if not self.causal:
+            return {"attention_mask": attention_mask} if attention_mask is not None else {}
+        batch_size, seq_len = inputs_embeds.shape[:2]
+        perm_mask = torch.triu(inputs_embeds.new_ones(seq_len, seq_len), diagonal=1).expand(batch_size, -1, -1)
+        if attention_mask is not None:
+            perm_mask = torch.maximum(perm_mask, 1 - attention_mask.to(perm_mask.dtype)[:, None, :])
+        return {"perm_mask": perm_mask}
+
+    def _get_name(self):
+        return "TransformerBlock"
+
+    def forward_output_size(self, input_size):
+        assert len(input_size) == 3
+        return torch.Size([input_size[0], input_size[1], self.transformer.config.hidden_size])
+
+def benchmark_padding(config, batch_size: int=256, max_seq_len: int=20,
+                      padding_ratios: Iterable[float]=(0., .25, .5, .75, .9),
+                      steps: int=20, warmup: int=3, seed: int=0, device: torch.device=device) -> pd.DataFrame:
+    """
+    Mean forward+backward time in ms of a `TransformerBlock` on left padded random sessions, without
+    attention mask, with it, and with it on the packed path, for several mean padding ratios
+    """
+    rng = np.random.default_rng(seed)
+    block = TransformerBlock(config).to(device)
+    packed_block = TransformerBlock(config, packed=True).to(device)
+    packed_block.load_state_dict(block.state_dict())
+    results = []
+    for padding_ratio in padding_ratios:
+        lengths = np.clip(rng.binomial(max_seq_len, 1 - padding_ratio, batch_size), 1, max_seq_len)
+        attention_mask = torch.from_numpy(np.arange(max_seq_len) >= max_seq_len - lengths[:, None]).float().to(device)
+        inputs = torch.randn(batch_size, max_seq_len, config.hidden_size, device=device)
+        timings = {'padding': 1 - lengths.mean() / max_seq_len}
+        runs = {'unmasked': lambda: block(inputs),
+                'masked': lambda: block(inputs, attention_mask=attention_mask),
+                'packed': lambda: packed_block(inputs, attention_mask=attention_mask)}
+        for name, run in runs.items():
+            for step in range(warmup + steps):
+                if step == warmup:
+                    start = time.perf_counter()
+                (run() * attention_mask.unsqueeze(-1)).sum().backward()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings[f'{name} ms'] = (time.perf_counter() - start) / steps * 1e3
+        results.append(timings)
+    return pd.DataFrame(results)
+
+"""#Head"""
+
+import torchmetrics as tm
+from abc import abstractmethod
+
+
+def check_inputs(ks, scores, labels):
+    if len(ks.shape) > 1:
+        raise ValueError("ks should be a 1-D tensor")
+
+    if len(scores.shape) != 2:
+        raise ValueError("scores must be a 2-D tensor")
+
+    if len(labels.shape) != 2:
+        raise ValueError("labels must be a 2-D tensor")
+
+    if scores.shape != labels.shape:
+        raise ValueError("scores and labels must be the same shape")
+
+    return (ks.to(dtype=torch.int32, device=scores.device), scores, labels,)
+
+def extract_topk(ks, scores, labels):
+    max_k = min(int(max(ks)), scores.shape[1])
+    topk_scores, topk_indices = torch.topk(scores, max_k)
+    topk_labels = torch.gather(labels, 1, topk_indices)
+    return topk_scores, topk_indices, topk_labels
+
+def create_output_placeholder(scores, ks):
+    return torch.zeros(scores.shape[0], len(ks)).to(device=scores.device, dtype=torch.float32)
+
+def topk_labels_from_ids(topk_indices, target_ids):
+    """ Relevance of the top-k items of every row for integer targets, without a (N, vocab) one-hot matrix """
+    return (topk_indices == target_ids.view(-1, 1)).to(dtype=torch.float32)
+
+def cutoff_columns(ks, topk_labels, cumulative):
+    """
+    Columns k-1 of a cumulative (N, max_k) tensor: its value at every cutoff.
+    Cutoffs past the number of ranked items (a vocabulary smaller than k) take the last column.
+    """
+    ks = ks.to(device=topk_labels.device, dtype=torch.long).clamp(max=topk_labels.shape[1])
+    return cumulative[:, ks - 1]
+
+
+class RankingMetric(tm.Metric):
+    """
+    Metric wrapper for computing ranking metrics@K for session-based task.
+    
+    Parameters
+    ----------
+    top_ks : list, default [2, 5])
+        list of cutoffs
+    labels_onehot : bool
+        Targets are item ids instead of one-hot labels. They are compared with the top-k indices
+        directly, so memory does not grow with the vocabulary size.
+    keep_rows : bool
+        Also keep the metrics of every row, returned by `rows()`. Memory then grows with the number of rows.
+    """
+
+    def __init__(self, top_ks=None, labels_onehot=False, keep_rows=False):
+        super(RankingMetric, self).__init__()
+        self.top_ks = top_ks or [2, 5]
+        self.labels_onehot = labels_onehot
+        self.keep_rows = keep_rows
+        # Running sum of the row metrics (for each cut-off at topk) and number of rows
+        self.add_state("metric_sum", default=torch.zeros(len(self.top_ks), dtype=torch.float64), dist_reduce_fx="sum")
+        self.add_state("num_rows", default=torch.tensor(0, dtype=torch.long), dist_reduce_fx="sum")
+        if keep_rows:
+            self.add_state("metric_rows", default=[], dist_reduce_fx="cat")
+
+    def update(self, preds: torch.Tensor, target: torch.Tensor, batch_metric: Optional[torch.Tensor] = None, **kwargs):  # type: ignore
+        # Computing the metrics at different cut-offs, unless a `RankingEvaluator` already did
+        if batch_metric is None:
+            preds = preds.view(-1, preds.size(-1))
+            if self.labels_onehot:
+                _, topk_indices = torch.topk(preds, min(int(max(self.top_ks)), preds.shape[1]))
+                topk_labels = topk_labels_from_ids(topk_indices, target)
+                batch_metric = self.metric_topk(topk_labels, torch.ones(topk_labels.shape[0], device=preds.device))
+            else:
+                batch_metric = self._metric(torch.LongTensor(self.top_ks), preds, target)
+        self.accumulate(batch_metric)
+
+    def metric_topk(self, topk_labels: torch.Tensor, num_relevant: torch.Tensor) -> torch.Tensor:
+        """ (N, len(top_ks)) metrics from the relevance of top-k items, which may extend past the largest cutoff """
+        ks = torch.LongTensor(self.top_ks).to(topk_labels.device)
+        return self._metric_topk(ks, topk_labels[:, :int(max(self.top_ks))], num_relevant)
+
+    def accumulate(self, metric: torch.Tensor):
+        """ Fold the (N, len(ks)) row metrics of a batch into the state """
+        self.metric_sum += metric.sum(dim=0).to(self.metric_sum)
+        self.num_rows += metric.shape[0]
+        if self.keep_rows:
+            self.metric_rows.append(metric)  # type: ignore
+
+    def compute(self):
+        # Computing the mean of the row metrics (for each cut-off at topk)
+        return (self.metric_sum / self.num_rows.clamp(min=1)).to(dtype=torch.float32)
+
+    def rows(self) -> torch.Tensor:
+        """ Metrics of every row seen, only kept with `keep_rows=True` """
+        if not self.keep_rows:
+            raise ValueError(f"{self.__class__.__name__} was created without keep_rows=True")
+        return tm.utilities.dim_zero_cat(self.metric_rows)
+
+    def _metric(self, ks: torch.Tensor, scores: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        """
+        Compute a ranking metric over a predictions and one-hot targets.
+        
+        Parameters
+        ----------
+        ks : torch.Tensor or list
+            list of cutoffs
+        scores : torch.Tensor
+            predicted item scores
+        labels : torch.Tensor
+            true item labels
+        
+        Returns
+        -------
+        torch.Tensor:
+            list of metrics at cutoffs
+        """
+        ks, scores, labels = check_inputs(ks, scores, labels)
+        _, _, topk_labels = extract_topk(ks, scores, labels)
+        return self._metric_topk(ks, topk_labels.to(dtype=torch.float32), labels.sum(dim=1).to(dtype=torch.float32))
+
+    @abstractmethod
+    def _metric_topk(self, ks: torch.Tensor, topk_labels: torch.Tensor, num_relevant: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the metric at every cutoff in one pass over the relevance of the top-k items.
+        This method should be overridden by subclasses.
+        
+        Parameters
+        ----------
+        ks : torch.Tensor
+            cutoffs, at most the number of columns of `topk_labels`
+        topk_labels : torch.Tensor
+            (N, max_k) relevance of the top-k items, in rank order
+        num_relevant : torch.Tensor
+            (N,) number of relevant items of every row
+        
+        Returns
+        -------
+        torch.Tensor:
+            (N, len(ks)) metrics at cutoffs
+        """
+
+class PrecisionAt(RankingMetric):
+    def __init__(self, top_ks=None, labels_onehot=False, keep_rows=False):
+        super(PrecisionAt, self).__init__(top_ks=top_ks, labels_onehot=labels_onehot, keep_rows=keep_rows)
+
+    def _metric_topk(self, ks: torch.Tensor, topk_labels: torch.Tensor, num_relevant: torch.Tensor) -> torch.Tensor:
+        """ Compute precision@K for each of the provided cutoffs """
+        hits = cutoff_columns(ks, topk_labels, topk_labels.cumsum(dim=1))
+        return hits / ks.to(device=topk_labels.device, dtype=torch.float32)
+
+
+class RecallAt(RankingMetric):
+    def __init__(self, top_ks=None, labels_onehot=False, keep_rows=False):
+        super(RecallAt, self).__init__(top_ks=top_ks, labels_onehot=labels_onehot, keep_rows=keep_rows)
+
+    def _metric_topk(self, ks: torch.Tensor, topk_labels: torch.Tensor, num_relevant: torch.Tensor) -> torch.Tensor:
+        """ Compute recall@K for each of the provided cutoffs """
+        hits = cutoff_columns(ks, topk_labels, topk_labels.cumsum(dim=1))
+        # rows without relevant items have a recall of 0
+        num_relevant = num_relevant.unsqueeze(1)
+        return torch.where(num_relevant != 0, hits / num_relevant.clamp(min=1), torch.zeros_like(hits))
+
+
+class AvgPrecisionAt(RankingMetric):
+    def __init__(self, top_ks=None, labels_onehot=False, keep_rows=False):
+        super(AvgPrecisionAt, self).__init__(top_ks=top_ks, labels_onehot=labels_onehot, keep_rows=keep_rows)
+
+    def _metric_topk(self, ks: torch.Tensor, topk_labels: torch.Tensor, num_relevant: torch.Tensor) -> torch.Tensor:
+        """ Compute average precision at K for provided cutoffs """
+        positions = torch.arange(1, topk_labels.shape[1] + 1, device=topk_labels.device, dtype=torch.float32)
+        precisions = topk_labels.cumsum(dim=1) / positions
+        total_prec = cutoff_columns(ks, topk_labels, (precisions * topk_labels).cumsum(dim=1))
+        ks = ks.to(device=topk_labels.device, dtype=torch.float32)
+        return total_prec / torch.minimum(num_relevant.unsqueeze(1).clamp(min=1), ks.unsqueeze(0))
+
+def discounts(max_k: int, device, log_base: int=2):
+    positions = torch.arange(max_k, device=device, dtype=torch.float32)
+    return 1 / (torch.log(positions + 2) / m.log(log_base))
+
+
+class DCGAt(RankingMetric):
+    def __init__(self, top_ks=None, labels_onehot=False, keep_rows=False):
+        super(DCGAt, self).__init__(top_ks=top_ks, labels_onehot=labels_onehot, keep_rows=keep_rows)
+
+    def _metric_topk(self, ks: torch.Tensor, topk_labels: torch.Tensor, num_relevant: torch.Tensor, log_base: int=2) -> torch.Tensor:
+        """ Compute discounted cumulative gain at K for provided cutoffs (ignoring ties) """
+        return cutoff_columns(ks, topk_labels, (topk_labels * discounts(topk_labels.shape[1], topk_labels.device, log_base)).cumsum(dim=1))
+
+
+class NDCGAt(RankingMetric):
+    def __init__(self, top_ks=None, labels_onehot=False, keep_rows=False):
+        super(NDCGAt, self).__init__(top_ks=top_ks, labels_onehot=labels_onehot, keep_rows=keep_rows)
+
+    def _metric_topk(self, ks: torch.Tensor, topk_labels: torch.Tensor, num_relevant: torch.Tensor, log_base: int = 2) -> torch.Tensor:
+        """ Compute normalized discounted cumulative gain at K for provided cutoffs (ignoring ties) """
+        position_discounts = discounts(topk_labels.shape[1], topk_labels.device, log_base)
+        gains = cutoff_columns(ks, topk_labels, (topk_labels * position_discounts).cumsum(dim=1))
+        # the ideal ranking puts the retrieved relevant items first
+        ideal_labels = topk_labels.sort(dim=1, descending=True).values
+        gains_normalized = cutoff_columns(ks, topk_labels, (ideal_labels * position_discounts).cumsum(dim=1))
+        return torch.where(gains_normalized != 0, gains / gains_normalized.clamp(min=1e-12), torch.zeros_like(gains))
+
+class RankingEvaluator(nn.Module):
+    """
+    Evaluates several ranking metrics with a single `torch.topk` per batch. The top-k of the largest
+    cutoff is taken once and its relevance is passed to every metric, which keeps the first columns it needs.
+    The metrics are submodules, so their states follow the evaluator (and its model) across devices.
+    
+    Parameters
+    ----------
+    metrics : Iterable[RankingMetric]
+        metrics to update, all with the same `labels_onehot`
+    """
+
+    def __init__(self, metrics: Iterable[RankingMetric]):
+        super(RankingEvaluator, self).__init__()
+        self.metrics = metrics if isinstance(metrics, nn.ModuleList) else nn.ModuleList(metrics)
+        if len({metric.labels_onehot for metric in self.metrics}) > 1:
+            raise ValueError("RankingEvaluator metrics must all use the same labels_onehot")
+        self.max_k = max(int(max(metric.top_ks)) for metric in self.metrics) if self.metrics else 0
+
+    def topk(self, scores: torch.Tensor, targets: torch.Tensor):
+        """ Relevance (N, max_k) of the top-k items of every row and number of relevant items (N,) """
+        scores = scores.view(-1, scores.size(-1))
+        _, topk_indices = torch.topk(scores, min(self.max_k, scores.shape[1]))
+        if self.metrics[0].labels_onehot:
+            topk_labels = topk_labels_from_ids(topk_indices, targets)
+            num_relevant = torch.ones(topk_labels.shape[0], device=scores.device)
+        else:
+            targets = targets.view(-1, targets.size(-1))
+            topk_labels = torch.gather(targets, 1, topk_indices).to(dtype=torch.float32)
+            num_relevant = targets.sum(dim=1).to(dtype=torch.float32)
+        return topk_labels, num_relevant
+
+    def update(self, scores: torch.Tensor, targets: torch.Tensor) -> List[torch.Tensor]:
+        """ Update every metric with a batch of scores and targets, returning the metrics of the batch """
+        if not self.metrics:
+            return []
+        topk_labels, num_relevant = self.topk(scores, targets)
+        batch_metrics = []
+        for metric in self.metrics:
+            batch_metric = metric.metric_topk(topk_labels, num_relevant)
+            metric.update(scores, targets, batch_metric=batch_metric)
+            batch_metrics.append(batch_metric.mean(dim=0))
+        return batch_metrics
+
+    def compute(self) -> List[torch.Tensor]:
+        return [metric.compute() for metric in self.metrics]
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+
+def benchmark_ranking_evaluator(metrics: Iterable[RankingMetric], vocab_size: int = 100_000, num_rows: int = 512,
+                                num_batches: int = 10, device=device) -> Dict[str, float]:
+    """
+    Time the metrics updated one by one (one `torch.topk` each) against a `RankingEvaluator`,
+    on random full-catalogue scores and item id targets, returning the ms per batch of both.
+    """
+    metrics = list(metrics)
+    scores = torch.randn(num_rows, vocab_size, device=device)
+    targets = torch.randint(1, vocab_size, (num_rows,), device=device)
+
+    def run(update):
+        for metric in metrics:
+            metric.reset()
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            update()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / num_batches * 1000
+
+    separate_ms = run(lambda: [metric.update(scores, targets) for metric in metrics])
+    separate = [metric.compute() for metric in metrics]
+    evaluator = RankingEvaluator(metrics)
+    fused_ms = run(lambda: evaluator.update(scores, targets))
+    for before, after in zip(separate, evaluator.compute()):
+        assert torch.allclose(before, after)
+    return {'metrics': len(metrics), 'vocab_size': vocab_size, 'separate_ms': separate_ms, 'fused_ms': fused_ms}
+
+class NegativeSampler(nn.Module):
+    """
+    Draw the negatives shared by all positions of a batch for sampled softmax, together with
+    the log expected number of draws of every item, used for the logQ correction.
+    
+    Parameters
+    ----------
+    num_items: int
+        Vocabulary size of item ids, including the padding row.
+    num_negatives: int
+        Number of negatives per batch, for `uniform` and `popularity` sampling.
+    strategy: str
+        `uniform`, `popularity` (proportional to `item_counts`) or `in-batch` (the targets of the batch).
+    item_counts: torch.Tensor
+        Occurrences of every item, required by `popularity`.
+    padding_idx: int
+        Row never drawn as a negative.
+    """
+    STRATEGIES = ('uniform', 'popularity', 'in-batch')
+
+    def __init__(self, num_items: int, num_negatives: int = 1024, strategy: str = 'uniform',
+                       item_counts: Optional[torch.Tensor] = None, padding_idx: int = 0):
+        super(NegativeSampler, self).__init__()
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"strategy must be one of {self.STRATEGIES}, found: {strategy}")
+        if strategy == 'popularity' and item_counts is None:
+            raise ValueError("popularity sampling needs item_counts")
+        self.num_items = num_items
+        self.num_negatives = num_negatives
+        self.strategy = strategy
+        self.padding_idx = padding_idx
+        if strategy == 'popularity':
+            probs = torch.as_tensor(item_counts, dtype=torch.float32).clone()
+            probs[padding_idx] = 0
+            self.register_buffer('probs', probs / probs.sum(), persistent=False)
+
+    def forward(self, targets: torch.Tensor):
+        """
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+            negatives (K,), log expected draws of the negatives (K,) and of the targets (N,)
+        """
+        if self.strategy == 'in-batch':
+            negatives, counts = torch.unique(targets, return_counts=True)
+            log_q = torch.log(counts.float())
+            return negatives, log_q, log_q[torch.searchsorted(negatives, targets)]
+        if self.strategy == 'uniform':
+            negatives = torch.randint(self.padding_idx + 1, self.num_items, (self.num_negatives,), device=targets.device)
+            log_q = torch.full((self.num_items,), m.log(self.num_negatives / (self.num_items - 1)), device=targets.device)
+        else:
+            negatives = torch.multinomial(self.probs, self.num_negatives, replacement=True)
+            log_q = torch.log(self.num_negatives * self.probs.clamp(min=1e-12))
+        return negatives, log_q[negatives], log_q[targets]
+
+
+class NextItemPredictionBlock(nn.Module):
+    """
+    Predict the interacted item-id probabilities.
+    - During inference, the task consists of predicting the next item.
+    - During training, the class supports the following Language modeling tasks:
+        Causal LM, Masked LM, Permutation LM and Replacement Token Detection
+        
+    Parameters:
+    -----------
+    input_size: int
+        Input size of this module.
+    target_dim: int
+        Dimension of the target.
+    weight_tying: bool
+        The embedding table weights are shared with the prediction network layer.
+    embedding_table: torch.nn.Module
+        Module that's used to store the embedding table for the item.
+    softmax_temperature: float
+        Softmax temperature, used to reduce model overconfidence, so that softmax(logits / T).
+        Value 1.0 is equivalent to regular softmax.
+    sampler: NegativeSampler, optional
+        Negative sampler enabling the sampled softmax loss of `sampled_loss`.
+    """
+
+    def __init__(self, input_size: int,
+                       target_dim: int,
+                     weight_tying: bool = False,
+                  embedding_table: Optional[nn.Module] = None,
+              softmax_temperature: float = 0.,
+                          sampler: Optional[NegativeSampler] = None):
+        super().__init__()
+        self.input_size = input_size
+        self.target_dim = target_dim
+        self.weight_tying = weight_tying
+        self.embedding_table = embedding_table
+        self.softmax_temperature = softmax_temperature
+        self.sampler = sampler
+        self.activation = nn.LogSoftmax(dim=-1)
+
+        if self.weight_tying:
+            self.output_layer_bias = nn.Parameter(torch.Tensor(self.target_dim))
+            torch.nn.init.zeros_(self.output_layer_bias)
+        else:
+            self.output_layer = nn.Linear(self.input_size[-1], self.target_dim)
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        if self.weight_tying:
+            logits = F.linear(inputs,
+                              weight=self.embedding_table.weight, 
+                              bias=self.output_layer_bias,)
+        else:
+            logits = self.output_layer(inputs)
+
+        if self.softmax_temperature > 0:
+            # Softmax temperature to reduce model overconfidence
+            logits = torch.div(logits, self.softmax_temperature)
+
+        predictions = self.activation(logits)
+        return predictions
+
+    def output_weights(self):
+        if self.weight_tying:
+            return self.embedding_table.weight, self.output_layer_bias
+        return self.output_layer.weight, self.output_layer.bias
+
+    def sampled_loss(self, inputs: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+        """
+        Sampled softmax cross-entropy of `targets` against the negatives shared by the batch,
+        with logits corrected by the log expected number of draws (logQ) of every item.
+        The cost is linear in the number of negatives instead of in the catalogue size.
+        
+        Parameters
+        ----------
+        inputs: torch.Tensor
+            (N, D) representations of the non-padded positions.
+        targets: torch.Tensor
+            (N,) target item ids.
+        """
+        weight, bias = self.output_weights()
+        negatives, negatives_log_q, targets_log_q = self.sampler(targets)
+        target_logits = (inputs * weight[targets]).sum(dim=-1) + bias[targets] - targets_log_q
+        negative_logits = F.linear(inputs, weight[negatives], bias[negatives]) - negatives_log_q
+        # a negative equal to the target is not a negative
+        negative_logits = negative_logits.masked_fill(negatives.unsqueeze(0) == targets.unsqueeze(1), float('-inf'))
+        logits = torch.cat([target_logits.unsqueeze(1), negative_logits], dim=1)
+        if self.softmax_temperature > 0:
+            logits = torch.div(logits, self.softmax_temperature)
+        return F.cross_entropy(logits, torch.zeros_like(targets, dtype=torch.long))
+
+    def _get_name(self) -> str:
+        return "NextItemPredictionTask"
+
+
+def benchmark_sampled_softmax(vocab_sizes: Iterable[int] = (10_000, 100_000, 1_000_000), num_targets: int = 256,
+                              dim: int = 64, num_negatives: int = 1024, steps: int = 10) -> Dict[int, Dict[str, float]]:
+    """ Training steps/sec of the output layer with the full and the sampled softmax losses, per vocabulary size """
+    results = {}
+    for vocab_size in vocab_sizes:
+        embedding = nn.Embedding(vocab_size, dim)
+        inputs = torch.randn(num_targets, dim)
+        targets = torch.randint(1, vocab_size, (num_targets,))
+        block = NextItemPredictionBlock(input_size=dim, target_dim=vocab_size, weight_tying=True, embedding_table=embedding,
+                                        sampler=NegativeSampler(vocab_size, num_negatives=num_negatives))
+        losses = {'full': lambda: F.nll_loss(block(inputs), targets),
+                  'sampled': lambda: block.sampled_loss(inputs, targets)}
+        results[vocab_size] = {}
+        for name, loss_fn in losses.items():
+            loss_fn().backward()
+            start = time.perf_counter()
+            for _ in range(steps):
+                loss_fn().backward()
+            results[vocab_size][name] = steps / (time.perf_counter() - start)
+    return results
+
+class NextItemPredictionTask(nn.Module):
+    """
+    Next-item prediction task.
+    
+    Parameters
+    ----------
+    loss: torch.nn.Module
+        Loss function to use. Defaults to NLLLos.
+    metrics: Iterable[torchmetrics.Metric], optional
+        List of ranking metrics to use for evaluation, new `default_metrics()` without it.
+    task_block:
+        Module to transform input tensor before computing predictions.
+    task_name: str, optional
+        Name of the prediction task, if not provided a name will be automatically constructed based
+        on the target-name & class-name.
+    weight_tying: bool
+        The embedding table weights are shared with the prediction layer.
+    softmax_temperature: float
+        Softmax temperature, to reduce model overconfidence --> softmax(logits / Temp)
+        Value 1.0 is equivalent to regular softmax.
+    padding_idx: int
+        pad token id.
+    target_dim: int
+        vocabulary size of item ids
+    num_negatives: int
+        Number of sampled negatives of the training loss, 0 trains with the full softmax.
+    negative_sampling: str
+        Strategy of the `NegativeSampler`: uniform, popularity or in-batch.
+    item_counts: torch.Tensor, optional
+        Occurrences of every item id, for popularity sampling.
+    """
+
+    @staticmethod
+    def default_metrics() -> List[RankingMetric]:
+        """ New instances of the default metrics, so that no two tasks accumulate into the same state """
+        # default metrics suppose labels are int encoded
+        return [        NDCGAt(top_ks=[10, 20], labels_onehot=True),
+                      RecallAt(top_ks=[10, 20], labels_onehot=True),
+                AvgPrecisionAt(top_ks=[10, 20], labels_onehot=True),]
+
+    def __init__(self, loss: nn.Module = nn.NLLLoss(ignore_index=0),
+                    metrics: Optional[Iterable[tm.Metric]] = None,
+                 task_block: Optional[nn.Module] = None,
+                  task_name: str = "next-item",
+               weight_tying: bool = False,
+        softmax_temperature: float = 1.,
+                padding_idx: int = 0,
+                 target_dim: int = None,
+              num_negatives: int = 0,
+          negative_sampling: str = 'uniform',
+                item_counts: Optional[torch.Tensor] = None,):
+        super(NextItemPredictionTask, self).__init__()
+        self.loss = loss
+        self.metrics = nn.ModuleList(metrics if metrics is not None else self.default_metrics())
+        self.evaluator = RankingEvaluator(self.metrics)
+        self.task_name = task_name
+        self.task_block = task_block
+        self.softmax_temperature = softmax_temperature
+        self.embedding_table = None
+        self.weight_tying = weight_tying
+        self.padding_idx = padding_idx
+        self.target_dim = target_dim
+        self.num_negatives = num_negatives
+        self.negative_sampling = negative_sampling
+        self.item_counts = item_counts
+        self.masking = None
+
+    def build(self, input_size, masking=None, device=None, 
+                    embedding_block=None, task_block=None, predict_block=None):
+        if not len(input_size) == 3 or isinstance(input_size, dict):
+            raise ValueError("NextItemPredictionTask needs a 3-D tensor as input, found:" f"{input_size}")
+        self.device = device
+
+        # Retrieve the embedding module to get the name of item id col and its related table
+        self.task_block = task_block
+        self.embedding_block = embedding_block
+        if not self.target_dim:
+            self.target_dim = self.embedding_block.num_embeddings
+        if self.weight_tying:
+            self.item_embedding = self.embedding_block
+            item_dim = self.item_embedding.weight.shape[1]
+            if input_size[-1] != item_dim and not task_block:
+                self.task_block = nn.Linear(in_features=input_size[-1], 
+                                           out_features=item_dim)
+
+        # Retrieve the masking if used in the model block
+        self.masking = masking
+        if self.masking:
+            self.padding_idx = self.masking.padding_idx
+
+        sampler = None
+        if self.num_negatives or self.negative_sampling == 'in-batch':
+            sampler = NegativeSampler(num_items=self.target_dim,
+                                  num_negatives=self.num_negatives,
+                                       strategy=self.negative_sampling,
+                                    item_counts=self.item_counts,
+                                    padding_idx=self.padding_idx)
+
+        self.predict_block = NextItemPredictionBlock(input_size=input_size[-1], 
+                                                     target_dim=self.target_dim,
+                                                   weight_tying=self.weight_tying,
+                                                embedding_table=self.item_embedding,
+                                            softmax_temperature=self.softmax_temperature,
+                                                        sampler=sampler)
+    def forward(self, inputs: torch.Tensor, **kwargs):
+        # representations of the non-padded masked positions
+        x, _ = self.masked_inputs(inputs)
+
+        # Compute predictions probs
+        x = self.predict_block(x) 
+
+        return x
+
+    def masked_inputs(self, inputs: torch.Tensor):
+        """ Representations and target ids of the positions masked by `self.masking` """
+        if isinstance(inputs, (tuple, list)):
+            inputs = inputs[0]
+        x = inputs.float()
+        if self.task_block:
+            x = self.task_block(x)
+        target_flat = self.masking.masked_targets.flatten()
+        non_pad_mask = target_flat != self.padding_idx
+        return self.remove_pad_3d(x, non_pad_mask), torch.masked_select(target_flat, non_pad_mask).long()
+
+    def compute_loss(self, inputs: torch.Tensor, training: bool = True) -> torch.Tensor:
+        """ Sampled softmax loss in training when the block has a sampler, `self.loss` over the full softmax otherwise """
+        x, labels_all = self.masked_inputs(inputs)
+        if training and self.predict_block.sampler is not None:
+            return self.predict_block.sampled_loss(x, labels_all)
+        return self.loss(self.predict_block(x), labels_all)
+
+    def remove_pad_3d(self, inp_tensor, non_pad_mask):
+        # inp_tensor: (n_batch x seq_len x emb_dim)
+        inp_tensor = inp_tensor.flatten(end_dim=1)
+        inp_tensor_fl = torch.masked_select(inp_tensor, non_pad_mask.unsqueeze(1).expand_as(inp_tensor))
+        out_tensor = inp_tensor_fl.view(-1, inp_tensor.size(1))
+        return out_tensor
+
+    def metric_name(self, metric: tm.Metric) -> str:
+        name = re.sub(r'(.)([A-Z][a-z]+)', r'\1_\2', metric.__class__.__name__)
+        return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+    def calculate_metrics(self, predictions, targets=None, mode="val", forward=True, **kwargs) -> Dict[str, torch.Tensor]:
+        """
+        Update the metrics with a batch through `self.evaluator`, which runs `torch.topk` once for all of them.
+        With `forward`, `predictions` are the transformer outputs and the targets are the masked item ids,
+        the only labels aligned with the predicted rows. Otherwise `predictions` are (N, vocab) scores
+        and `targets` their (N,) item ids or (N, vocab) one-hot rows.
+        """
+        if forward:
+            x, targets = self.masked_inputs(predictions)
+            predictions = self.predict_block(x)
+        elif targets is None or isinstance(targets, dict):
+            raise ValueError("calculate_metrics needs targets aligned with the prediction rows when forward=False")
+
+        outputs = {}
+        for metric, batch_metric in zip(self.metrics, self.evaluator.update(predictions, targets)):
+            outputs[self.metric_name(metric)] = batch_metric
+
+        return outputs
+
+    def compute_metrics(self):
+        metrics = {self.metric_name(metric): metric.compute()
+                   for metric in self.metrics
+                   if getattr(metric, "top_ks", None)}
+        
+        # Explode metrics for each cut-off
+        topks = {self.metric_name(metric): metric.top_ks for metric in self.metrics}
+        results = {}
+        for name, metric in metrics.items():
+            for measure, k in zip(metric, topks[name]):
+                results[f"{name}_{k}"] = measure
+        return results
+
+"""#Inference"""
+
+class LatestSessionDataset(Dataset):
+    """
+    Batches of users for offline recommendation: the padded features of every user's latest session
+    and the items of all the user's sessions, which are not recommended again.
+    Sessions of a user are sorted by their start time, the last one being the latest.
+    
+    Parameters
+    ----------
+    store: PaddedTensorStore
+        Padded sessions, indexed by user id first.
+    batch_size: int
+        Number of users in a batch.
+    item_feat: str
+        Item id feature, holding embedding rows.
+    time_level: str, optional
+        Index level of the session start times, sessions are taken in store order without it.
+    """
+    def __init__(self, store: PaddedTensorStore, batch_size: int=1024, item_feat: str='item_ids',
+                       time_level: Optional[str]='session_initial_timestamp'):
+        self.store = store
+        self.batch_size = batch_size
+        self.item_feat = item_feat
+        user_codes, self.user_ids = pd.factorize(store.index.get_level_values(0))
+        if time_level is None:
+            times = np.zeros(len(user_codes))
+        elif time_level in store.index.names:
+            times = np.argsort(np.argsort(store.index.get_level_values(time_level).values, kind='stable'), kind='stable')
+        else:
+            raise ValueError(f"store index {store.index.names} has no {time_level} level to order the sessions by")
+        # sessions grouped by user, sorted by start time inside a user (store order on ties)
+        self.sessions = np.lexsort((times, user_codes))
+        self.user_offsets = np.concatenate([[0], np.cumsum(np.bincount(user_codes, minlength=len(self.user_ids)))])
+        self.latest = self.sessions[self.user_offsets[1:] - 1]
+
+    def __len__(self):
+        return int(m.ceil(len(self.user_ids) / self.batch_size))
+
+    def __getitem__(self, batch_id: int) -> Dict[str, torch.Tensor]:
+        if not 0 <= batch_id < len(self):
+            raise IndexError(f"batch {batch_id} out of range for {len(self)} batches")
+        start = batch_id * self.batch_size
+        end = min(start + self.batch_size, len(self.user_ids))
+        batch = {feat: torch.from_numpy(np.take(array, self.latest[start:end], axis=0))
+                 for feat, array in self.store.arrays.items()}
+
+        # (user in batch, item row) pairs of every non-padded item of the users' sessions
+        sessions = self.sessions[self.user_offsets[start]:self.user_offsets[end]]
+        seen_items = np.take(self.store.arrays[self.item_feat], sessions, axis=0)
+        seen_users = np.repeat(np.repeat(np.arange(end - start), np.diff(self.user_offsets[start:end + 1])),
+                               seen_items.shape[1])
+        seen_items = seen_items.ravel()
+        batch['users'] = torch.arange(start, end)
+        batch['seen_users'] = torch.from_numpy(seen_users[seen_items != 0])
+        batch['seen_items'] = torch.from_numpy(seen_items[seen_items != 0].astype(np.int64))
+        return batch
+
+
+def topk_unseen(hidden: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, k: int,
+                seen_users: torch.Tensor, seen_items: torch.Tensor, first_row: int=0,
+                item_chunk: int=65_536):
+    """
+    Top-k item rows of every user by `hidden @ weight.T + bias`, skipping the rows below `first_row`
+    and the (user, item) pairs already seen. Items are scored `item_chunk` rows at a time and merged
+    into a running top-k, so memory is `O(num_users * item_chunk)` whatever the catalogue size.
+    Users with fewer than k candidates get row 0 in the remaining slots.
+    """
+    num_users = hidden.shape[0]
+    best_scores = torch.full((num_users, k), float('-inf'), device=hidden.device)
+    best_items = torch.zeros((num_users, k), dtype=torch.long, device=hidden.device)
+    for start in range(first_row, weight.shape[0], item_chunk):
+        end = min(start + item_chunk, weight.shape[0])
+        scores = F.linear(hidden, weight[start:end], bias[start:end])
+        in_chunk = (seen_items >= start) & (seen_items < end)
+        scores[seen_users[in_chunk], seen_items[in_chunk] - start] = float('-inf')
+        chunk_scores, chunk_items = torch.topk(scores, min(k, end - start), dim=1)
+        merged_scores = torch.cat([best_scores, chunk_scores.float()], dim=1)
+        merged_items = torch.cat([best_items, chunk_items + start], dim=1)
+        best_scores, best = torch.topk(merged_scores, k, dim=1)
+        best_items = torch.gather(merged_items, 1, best)
+    return best_items.masked_fill(best_scores == float('-inf'), 0), best_scores
+
+
+class BatchRecommender:
+    """
+    Offline top-k recommendation of the next item for every user, written as the
+    `user_id, item_1, ..., item_k` rows of the simulator `recs.csv` (`REC_SIZE` is 8).
+    The latest session of a user goes through `FeaturePreprocessing → TransformerBlock` with a masked
+    position appended, whose output is scored against the item embeddings of the prediction head.
+    
+    Parameters
+    ----------
+    feature_processor: FeaturePreprocessing
+        Input features block.
+    masking: MaskSequence
+        Masking block, its masked embedding stands for the item to predict.
+    backbone: TransformerBlock
+        Sequence block.
+    head: NextItemPredictionTask
+        Built prediction task, giving the output item embeddings.
+    item_vocabulary: ItemVocabulary
+        Maps embedding rows back to raw item ids.
+    num_recs: int
+        Number of items recommended to each user.
+    item_chunk: int
+        Number of items scored at a time.
+    item_feat: str
+        Item id feature, whose zeros mark the padding.
+    """
+    def __init__(self, feature_processor: FeaturePreprocessing, masking: MaskSequence, backbone: TransformerBlock,
+                       head: NextItemPredictionTask, item_vocabulary: ItemVocabulary, num_recs: int=8,
+                       item_chunk: int=65_536, item_feat: str='item_ids', device: torch.device=device):
+        self.feature_processor = feature_processor
+        self.masking = masking
+        self.backbone = backbone
+        self.head = head
+        self.item_vocabulary = item_vocabulary
+        self.num_recs = num_recs
+        self.item_chunk = item_chunk
+        self.item_feat = item_feat
+        self.device = device
+
+    def user_representations(self, tensors: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """ (B, D) output at a masked position appended to the sessions, dropping their oldest step """
+        features, attention_mask = self.masking.append_masked_position(self.feature_processor(tensors),
+                                                                       tensors[self.item_feat])
+        hidden = self.backbone(features, attention_mask=attention_mask)[:, -1]
+        if self.head.task_block:
+            hidden = self.head.task_block(hidden)
+        return hidden
+
+    @torch.no_grad()
+    def recommend(self, batch: Dict[str, torch.Tensor]) -> np.ndarray:
+        """ (B, num_recs) raw item ids recommended to the users of a `LatestSessionDataset` batch """
+        batch = batch_to_device(batch, self.device)
+        hidden = self.user_representations({feat: batch[feat] for feat in self.feature_processor.features_order})
+        weight, bias = self.head.predict_block.output_weights()
+        rows, _ = topk_unseen(hidden, weight, bias, self.num_recs, batch['seen_users'], batch['seen_items'],
+                              first_row=self.item_vocabulary.first_row, item_chunk=self.item_chunk)
+        return self.item_vocabulary.decode(rows.cpu().numpy())
+
+    def write(self, path: str, dataset: LatestSessionDataset, num_workers: int=4) -> int:
+        """
+        Stream the recommendations of every user of `dataset` to the csv at `path`, batch by batch.
+        Batches are gathered by `num_workers` loader processes while the model runs in this one.
+        Returns the number of users written.
+        """
+        modules = [self.feature_processor, self.masking, self.backbone, self.head]
+        modes = [module.training for module in modules]
+        for module in modules:
+            module.eval()
+        loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers,
+                            pin_memory=self.device.type == 'cuda')
+        num_users = 0
+        try:
+            with open(path, 'w', newline='') as f:
+                for batch in tqdm(loader, total=len(dataset)):
+                    recs = self.recommend(batch)
+                    users = dataset.user_ids[batch['users'].numpy()]
+                    pd.DataFrame(recs, index=users).to_csv(f, header=False)
+                    num_users += len(users)
+        finally:
+            for module, mode in zip(modules, modes):
+                module.train(mode)
+        return num_users
+
+class ItemIndex:
+    """
+    Inverted file (IVF) index over item embeddings for approximate maximum inner product search.
+    Items are clustered by k-means into `num_lists` lists stored contiguously; a query scores the centroids,
+    probes its `nprobe` best lists and ranks their items exactly. The output bias of the prediction block
+    is folded in as one extra dimension, so scores are the logits `query @ weight.T + bias`.
+    
+    Parameters
+    ----------
+    weight: np.ndarray
+        (num_rows, D) item embeddings, e.g. `feature_processor.embedding['item_ids'].weight`.
+    bias: np.ndarray, optional
+        (num_rows,) output bias of the items.
+    first_row: int
+        Rows below are padding/OOV and never returned, see `ItemVocabulary.first_row`.
+    num_lists: int, optional
+        Number of inverted lists, about `sqrt(num_items)` by default.
+    train_size: int
+        Maximum number of items the centroids are trained on.
+    num_iters: int
+        k-means iterations.
+    seed: int
+        Seed of the centroid initialization and of the training sample.
+    """
+    def __init__(self, weight: np.ndarray, bias: Optional[np.ndarray]=None, first_row: int=0,
+                       num_lists: Optional[int]=None, train_size: int=100_000, num_iters: int=10, seed: int=0):
+        self.first_row = first_row
+        self.num_lists = num_lists
+        self.train_size = train_size
+        self.num_iters = num_iters
+        self.rng = np.random.default_rng(seed)
+        self.build(weight, bias)
+
+    @classmethod
+    def from_embedding(cls, embedding, bias: Optional[torch.Tensor]=None, **kwargs):
+        """ Index the rows of an `nn.Embedding` (or fused table view), with the output bias if given """
+        bias = bias.detach().float().cpu().numpy() if bias is not None else None
+        return cls(embedding.weight.detach().float().cpu().numpy(), bias, **kwargs)
+
+    def augment(self, weight: np.ndarray, bias: Optional[np.ndarray]=None) -> np.ndarray:
+        """ Item vectors with the bias appended, so that `[query, 1] @ vector` is the logit """
+        bias = np.zeros(len(weight), dtype=np.float32) if bias is None else bias
+        return np.ascontiguousarray(np.hstack([weight, bias[:, None]]), dtype=np.float32)
+
+    def build(self, weight: np.ndarray, bias: Optional[np.ndarray]=None):
+        """ Train the centroids and fill the inverted lists from scratch """
+        self.vectors = self.augment(weight, bias)
+        items = self.vectors[self.first_row:]
+        num_lists = self.num_lists or max(1, int(m.sqrt(len(items))))
+        sample = items[self.rng.choice(len(items), min(len(items), self.train_size), replace=False)]
+        self.centroids = sample[self.rng.choice(len(sample), min(num_lists, len(sample)), replace=False)].copy()
+        for _ in range(self.num_iters):
+            assignments = self.assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=len(self.centroids))
+            # empty lists keep their centroid
+            filled = counts > 0
+            self.centroids[filled] = sums[filled] / counts[filled, None]
+        self.assignments = self.assign(items)
+        self.pack()
+
+    def assign(self, vectors: np.ndarray, chunk_size: int=65_536) -> np.ndarray:
+        """ Nearest centroid (L2) of every vector """
+        centroid_norms = (self.centroids ** 2).sum(axis=1)
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            assignments[start:start + chunk_size] = np.argmin(centroid_norms - 2 * chunk @ self.centroids.T, axis=1)
+        return assignments
+
+    def pack(self):
+        """ Lay the items out list by list: `rows[list_offsets[l]:list_offsets[l+1]]` are the rows of list l """
+        order = np.argsort(self.assignments, kind='stable')
+        self.rows = order + self.first_row
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.assignments, minlength=len(self.centroids)))])
+        self.list_vectors = self.vectors[self.rows]
+
+    def update(self, weight: np.ndarray, bias: Optional[np.ndarray]=None, retrain_fraction: float=0.2) -> int:
+        """
+        Refresh the index after the embeddings changed: rows whose vector moved (and new rows) are
+        reassigned to the current centroids, the centroids are retrained only when more than
+        `retrain_fraction` of the items changed. Returns the number of reassigned items.
+        """
+        vectors = self.augment(weight, bias)
+        num_old = min(len(vectors), len(self.vectors)) - self.first_row
+        changed = np.ones(len(vectors) - self.first_row, dtype=bool)
+        changed[:num_old] = np.any(vectors[self.first_row:self.first_row + num_old]
+                                   != self.vectors[self.first_row:self.first_row + num_old], axis=1)
+        if changed.mean() > retrain_fraction:
+            self.build(weight, bias)
+            return len(changed)
+        self.vectors = vectors
+        assignments = np.empty(len(changed), dtype=np.int64)
+        assignments[:num_old] = self.assignments[:num_old]
+        assignments[changed] = self.assign(vectors[self.first_row:][changed])
+        self.assignments = assignments
+        self.pack()
+        return int(changed.sum())
+
+    def search(self, queries: np.ndarray, top_n: int=8, nprobe: int=8):
+        """
+        Approximate top-N items of a batch of session vectors.
+        
+        Parameters
+        ----------
+        queries: np.ndarray
+            (Q, D) session representations, e.g. `BatchRecommender.user_representations`.
+        top_n: int
+            Number of items returned per query.
+        nprobe: int
+            Number of lists probed per query, more is slower and closer to exact.
+        
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]:
+            (Q, top_n) item rows (ids of the embedding table, `ItemVocabulary.decode` gives raw ids)
+            and their scores, best first. Missing candidates have row 0 and score -inf.
+        """
+        queries = np.hstack([np.asarray(queries, dtype=np.float32), np.ones((len(queries), 1), dtype=np.float32)])
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        sizes = np.diff(self.list_offsets)[probes]
+        columns = np.cumsum(sizes, axis=1) - sizes
+        width = max(int(sizes.sum(axis=1).max()), top_n)
+        scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        candidates = np.zeros((len(queries), width), dtype=np.int64)
+        # one matmul per probed list, against the queries probing it
+        for list_id in np.unique(probes):
+            query_ids, probe_ids = np.nonzero(probes == list_id)
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            cols = columns[query_ids, probe_ids][:, None] + np.arange(end - start)
+            scores[query_ids[:, None], cols] = queries[query_ids] @ self.list_vectors[start:end].T
+            candidates[query_ids[:, None], cols] = self.rows[start:end]
+        best = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+        best = np.take_along_axis(best, np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1), axis=1)
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        return np.where(np.isfinite(best_scores), np.take_along_axis(candidates, best, axis=1), 0), best_scores
+
+    def exact_search(self, queries: np.ndarray, top_n: int=8, chunk_size: int=65_536):
+        """ Exact top-N by a full scan of the items, in chunks """
+        queries = np.hstack([np.asarray(queries, dtype=np.float32), np.ones((len(queries), 1), dtype=np.float32)])
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(self.first_row, len(self.vectors), chunk_size):
+            end = min(start + chunk_size, len(self.vectors))
+            scores = np.hstack([best_scores, queries @ self.vectors[start:end].T])
+            rows = np.hstack([best_rows, np.broadcast_to(np.arange(start, end), (len(queries), end - start))])
+            keep = np.argpartition(-scores, min(top_n, scores.shape[1]) - 1, axis=1)[:, :top_n]
+            best_scores, best_rows = np.take_along_axis(scores, keep, axis=1), np.take_along_axis(rows, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def benchmark_item_index(index: ItemIndex, queries: np.ndarray, top_n: int=8,
+                         nprobes: Iterable[int]=(1, 4, 16, 64)) -> pd.DataFrame:
+    """ Recall@top_n against the exact search and mean query time of the index for several `nprobe` """
+    start = time.perf_counter()
+    exact, _ = index.exact_search(queries, top_n)
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        approx, _ = index.search(queries, top_n, nprobe=nprobe)
+        query_ms = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(np.intersect1d(a, e)) / top_n for a, e in zip(approx, exact)])
+        results.append({'nprobe': nprobe, f'recall@{top_n}': recall, 'ms/query': query_ms, 'exact ms/query': exact_ms})
+    return pd.DataFrame(results)
+
+"""##Online inference"""
+
+class SessionStateCache:
+    """
+    Least recently used map from user ids to their backbone memory, holding at most `max_users` entries.
+    An entry is the list of per-layer `(mem_len, 1, D)` memories, i.e. `n_layer * mem_len * D` floats.
+    """
+    def __init__(self, max_users: int=10_000):
+        self.max_users = max_users
+        self.states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, user_id):
+        return user_id in self.states
+
+    def get(self, user_id) -> Optional[List[torch.Tensor]]:
+        state = self.states.get(user_id)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.states.move_to_end(user_id)
+        return state
+
+    def discard(self, user_id):
+        self.states.pop(user_id, None)
+
+    def put(self, user_id, state: List[torch.Tensor]):
+        self.states[user_id] = state
+        self.states.move_to_end(user_id)
+        while len(self.states) > self.max_users:
+            self.states.popitem(last=False)
+            self.evictions += 1
+
+
+class OnlineRecommender:
+    """
+    Per-event next-item scoring that keeps the XLNet memory of every user instead of
+    reprocessing the padded session: a new event is one incremental step of the backbone over
+    `[event, masked position]` attending to the cached hidden states of the user's previous events.
+    The modules are put in eval mode.
+    
+    With a causal backbone (an XLNet config with `attn_type="uni"`, trained as any other through
+    `NextItemModel` and `Trainer`) the scores are those of the full session forward of a `SessionScorer`;
+    with the default bidirectional attention, past events do not see the later ones as they do in a
+    full forward.
+    
+    Parameters
+    ----------
+    feature_processor: FeaturePreprocessing
+        Input features block.
+    masking: MaskSequence
+        Masking block, its masked embedding stands for the item to predict.
+    backbone: TransformerBlock
+        Sequence block wrapping an XLNet model.
+    head: NextItemPredictionTask
+        Built prediction task.
+    mem_len: int
+        Number of past events kept per user.
+    max_users: int
+        Size bound of the `SessionStateCache`.
+    item_feat: str
+        Item id feature, whose zeros mark the padding of primed sessions.
+    """
+    def __init__(self, feature_processor: FeaturePreprocessing, masking: MaskSequence, backbone: TransformerBlock,
+                       head: NextItemPredictionTask, mem_len: int=20, max_users: int=10_000,
+                       item_feat: str='item_ids', device: torch.device=device):
+        if 'mems' not in backbone.forward_params:
+            raise ValueError(f"{type(backbone.transformer).__name__} does not take a memory of past states")
+        self.feature_processor = feature_processor.eval()
+        self.masking = masking.eval()
+        self.backbone = backbone.eval()
+        self.head = head.eval()
+        self.mem_len = mem_len
+        self.item_feat = item_feat
+        self.cache = SessionStateCache(max_users)
+        self.device = device
+
+    def advance(self, features: torch.Tensor, mems: Optional[List[torch.Tensor]]):
+        """
+        Run `(1, n, D)` event features followed by the masked position on top of `mems`.
+        Returns the output at the masked position and the memory extended with the n events.
+        """
+        masked = self.masking.masked_item_embedding.to(features.dtype).view(1, 1, -1)
+        inputs = torch.cat([features, masked], dim=1)
+        # the memory is always attended to, a causal backbone masks the later positions of the step
+        outputs = self.backbone.transformer(inputs_embeds=inputs, mems=mems, **self.backbone.mask_arguments(inputs),
+                                            use_mems=False, output_hidden_states=True, return_dict=True)
+        # hidden_states[i] is the (batch-first) input of layer i, the memory XLNet attends to
+        num_events = features.shape[1]
+        new_mems = []
+        for layer, hidden in enumerate(outputs.hidden_states[:-1]):
+            hidden = hidden[:, :num_events].transpose(0, 1)
+            if mems is not None:
+                hidden = torch.cat([mems[layer], hidden], dim=0)
+            new_mems.append(hidden[-self.mem_len:])
+        return outputs.last_hidden_state[:, -1], new_mems
+
+    def scores(self, hidden: torch.Tensor) -> torch.Tensor:
+        if self.head.task_block:
+            hidden = self.head.task_block(hidden)
+        return self.head.predict_block(hidden)[0]
+
+    @torch.no_grad()
+    def prime(self, user_id, tensors: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """ Start the memory of `user_id` from a left padded `(1, L)` session, returning its scores """
+        tensors = batch_to_device(tensors, self.device)
+        length = int((tensors[self.item_feat] != 0).sum())
+        features = self.feature_processor(tensors)
+        hidden, mems = self.advance(features[:, features.shape[1] - length:], None)
+        self.cache.put(user_id, mems)
+        return self.scores(hidden)
+
+    @torch.no_grad()
+    def step(self, user_id, new_event: Dict[str, Union[int, float]]) -> torch.Tensor:
+        """
+        Log-probabilities over the item rows of the next item of `user_id` after `new_event`,
+        a mapping of every schema feature to its (encoded) value. Unknown users start from an empty memory.
+        """
+        tensors = {feat: torch.tensor([[new_event[feat]]], device=self.device,
+                                      dtype=torch.long if feat in self.feature_processor.embedding.keys() else torch.float32)
+                   for feat in self.feature_processor.features_order}
+        hidden, mems = self.advance(self.feature_processor(tensors), self.cache.get(user_id))
+        self.cache.put(user_id, mems)
+        return self.scores(hidden)
+
+
+def benchmark_online_inference(online: OnlineRecommender, store: PaddedTensorStore, num_sessions: int=100,
+                               percentiles: Iterable[int]=(50, 90, 99), top_k: int=10) -> pd.DataFrame:
+    """
+    Replay the events of `num_sessions` sessions one at a time, timing `online.step` against the
+    full forward of a `SessionScorer` over the left padded session up to the event. Returns the
+    latency percentiles in ms.
+    With a causal backbone both give the same `top_k` items, which is checked whenever the events
+    fit in the memory and in the window of the full forward.
+    """
+    scorer = SessionScorer(online.feature_processor, online.masking, online.backbone, online.head).eval()
+    max_seq_len = store.max_seq_len
+    latencies = {'incremental': [], 'full': []}
+    for position in range(min(num_sessions, len(store))):
+        length = int(store.lengths[position])
+        rows = {feat: np.asarray(store.arrays[feat][position]) for feat in store.features}
+        # every replay starts from an empty memory
+        online.cache.discard(('benchmark', position))
+        for step in range(max_seq_len - length, max_seq_len):
+            event = {feat: rows[feat][step].item() for feat in store.features}
+            start = time.perf_counter()
+            incremental = online.step(('benchmark', position), event)
+            latencies['incremental'].append(time.perf_counter() - start)
+
+            window = [torch.from_numpy(np.concatenate([np.zeros(max_seq_len - 1 - step, dtype=rows[feat].dtype),
+                                                       rows[feat][:step + 1]])).view(1, -1).to(online.device)
+                      for feat in scorer.features_order]
+            start = time.perf_counter()
+            with torch.no_grad():
+                full = scorer(*window)[0]
+            latencies['full'].append(time.perf_counter() - start)
+
+            num_events = step - (max_seq_len - length) + 1
+            if online.backbone.causal and num_events < max_seq_len and num_events <= online.mem_len:
+                assert set(incremental.topk(top_k).indices.tolist()) == set(full.topk(top_k).indices.tolist()), \
+                    f"incremental and full top-{top_k} differ for session {position} after {num_events} events"
+    return pd.DataFrame({mode: {f'p{q}': np.percentile(values, q) * 1000 for q in percentiles}
+                         for mode, values in latencies.items()}).T
+
+"""##Export"""
+
+class SessionScorer(nn.Module):
+    """
+    End-to-end next-item scoring `FeaturePreprocessing → MaskedLanguageModeling → TransformerBlock →
+    NextItemPredictionTask` for inference: the masked embedding is appended to the sessions (dropping their
+    oldest step) and the output at that position is scored against every item.
+    Features are taken as positional tensors in `features_order`, so the module can be traced and exported.
+    """
+    def __init__(self, feature_processor: FeaturePreprocessing, masking: MaskSequence, backbone: TransformerBlock,
+                       head: NextItemPredictionTask, item_feat: str='item_ids'):
+        super(SessionScorer, self).__init__()
+        self.feature_processor = feature_processor
+        self.masking = masking
+        self.backbone = backbone
+        self.head = head
+        self.features_order = list(feature_processor.features_order)
+        self.item_feat = item_feat
+
+    def forward(self, *tensors: torch.Tensor) -> torch.Tensor:
+        tensors = dict(zip(self.features_order, tensors))
+        features, attention_mask = self.masking.append_masked_position(self.feature_processor(tensors),
+                                                                       tensors[self.item_feat])
+        hidden = self.backbone(features, attention_mask=attention_mask)[:, -1]
+        if self.head.task_block:
+            hidden = self.head.task_block(hidden)
+        return self.head.predict_block(hidden)
+
+
+def export_session_scorer(scorer: SessionScorer, example: Dict[str, torch.Tensor], mode: str='trace',
+                          path: Optional[str]=None):
+    """
+    Compiled version of `scorer` for CPU inference, called with the feature tensors in `features_order`.
+    
+    Parameters
+    ----------
+    scorer: SessionScorer
+        Model to compile, put in eval mode.
+    example: Dict[str, torch.Tensor]
+        Batch of padded sessions to trace with. The traced and ONNX graphs are specialized
+        to its sequence length, the batch size stays free.
+    mode: str
+        `compile` for `torch.compile`, `trace` for a frozen TorchScript trace (saved to `path` if given),
+        `onnx` for an ONNX graph written to `path` and run by onnxruntime.
+    path: str, optional
+        Output file of the TorchScript or ONNX model.
+    """
+    scorer = scorer.eval()
+    inputs = tuple(example[feat] for feat in scorer.features_order)
+    if mode == 'compile':
+        return torch.compile(scorer, dynamic=False)
+    if mode == 'trace':
+        with torch.no_grad():
+            module = torch.jit.freeze(torch.jit.trace(scorer, inputs, check_trace=False))
+        if path is not None:
+            module.save(path)
+        return module
+    if mode == 'onnx':
+        if path is None:
+            raise ValueError("ONNX export needs a path")
+        with torch.no_grad():
+            torch.onnx.export(scorer, inputs, path, input_names=scorer.features_order, output_names=['scores'],
+                              dynamic_axes={**{feat: {0: 'batch'} for feat in scorer.features_order},
+                                            'scores': {0: 'batch'}})
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return lambda *tensors: torch.from_numpy(session.run(None, {feat: tensor.numpy() for feat, tensor
+                                                                    in zip(scorer.features_order, tensors)})[0])
+    raise ValueError(f"Unknown export mode {mode}, expected compile, trace or onnx")
+
+
+def benchmark_session_scorer(scorer: SessionScorer, batch: Dict[str, torch.Tensor],
+                             modes: Iterable[str]=('trace', 'compile'), steps: int=50, warmup: int=5) -> Dict[str, float]:
+    """ Mean inference time in ms of `scorer` on `batch`, eager and compiled, checking the compiled scores """
+    scorer = scorer.eval()
+    inputs = tuple(batch[feat] for feat in scorer.features_order)
+    with torch.no_grad():
+        expected = scorer(*inputs)
+    models = {'eager': scorer, **{mode: export_session_scorer(scorer, batch, mode) for mode in modes}}
+    timings = {}
+    for mode, model in models.items():
+        with torch.no_grad():
+            for step in range(warmup + steps):
+                if step == warmup:
+                    start = time.perf_counter()
+                scores = model(*inputs)
+        timings[mode] = (time.perf_counter() - start) / steps * 1e3
+        if not torch.allclose(scores, expected, atol=1e-4):
+            raise AssertionError(f"{mode} scores differ from eager ones")
+    return timings
+
+"""#Training"""
+
+class StageProfiler:
+    """
+    Opt-in instrumentation of the stages of a `NextItemModel`: batch fetch, `FeaturePreprocessing`,
+    `MaskSequence`, `TransformerBlock`, `NextItemPredictionBlock` and the metrics updates.
+    For every stage it records the calls, the wall-time, the bytes of the outputs (and the peak of
+    allocated device memory on GPU hosts) and the most frequent output shapes.
+    
+    Use it as a context: nothing is instrumented until `attach` registers the hooks, and leaving the
+    context removes them, so the model runs unchanged afterwards. With `trace_dir` a `torch.profiler`
+    trace of the steps `[trace_wait, trace_wait + trace_steps)` of the context is written for TensorBoard,
+    and with `summary_path` the JSON summary is written when the context exits.
+    
+    Parameters
+    ----------
+    summary_path: str, optional
+        JSON file of the per-stage summary, written when the context exits.
+    trace_dir: str, optional
+        Directory of the `torch.profiler` trace, no trace is captured without it.
+    trace_wait: int
+        Steps skipped before the traced window (one more warms the profiler up).
+    trace_steps: int
+        Number of traced steps.
+    max_shapes: int
+        Number of distinct output shapes kept per stage.
+    """
+    STAGES = {FeaturePreprocessing: 'feature_preprocessing', MaskSequence: 'masking',
+              TransformerBlock: 'transformer', NextItemPredictionBlock: 'prediction'}
+
+    def __init__(self, summary_path: Optional[str]=None, trace_dir: Optional[str]=None,
+                       trace_wait: int=10, trace_steps: int=5, max_shapes: int=5):
+        self.max_shapes = max_shapes
+        self.stats = {}
+        self.starts = {}
+        self.handles = []
+        self.patched = []
+        self.cuda = torch.cuda.is_available()
+        self.summary_path = summary_path
+        self.trace_dir = trace_dir
+        self.trace_wait = trace_wait
+        self.trace_steps = trace_steps
+        self.trace = None
+
+    def __enter__(self) -> 'StageProfiler':
+        if self.trace_dir:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True,
+                schedule=torch.profiler.schedule(wait=self.trace_wait, warmup=1, active=self.trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir))
+            self.trace.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.detach()
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        if self.summary_path:
+            self.write_summary(self.summary_path)
+
+    def attach(self, model: nn.Module) -> 'StageProfiler':
+        """ Register the stage hooks on the modules of `model` and wrap the metrics and sampled loss """
+        for module in model.modules():
+            stage = next((name for cls, name in self.STAGES.items() if isinstance(module, cls)), None)
+            if stage is not None:
+                self.handles.append(module.register_forward_pre_hook(
+                    lambda module, inputs, stage=stage: self.start(stage)))
+                self.handles.append(module.register_forward_hook(
+                    lambda module, inputs, output, stage=stage: self.stop(stage, output)))
+            if isinstance(module, NextItemPredictionBlock):
+                # the sampled softmax of training bypasses forward
+                self.wrap(module, 'sampled_loss', 'prediction')
+            if isinstance(module, NextItemPredictionTask):
+                self.wrap(module.evaluator, 'update', 'metrics')
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        for obj, name in self.patched:
+            delattr(obj, name)
+        self.handles, self.patched = [], []
+
+    def wrap(self, obj, name: str, stage: str):
+        method = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            self.start(stage)
+            output = method(*args, **kwargs)
+            self.stop(stage, output)
+            return output
+        setattr(obj, name, timed)
+        self.patched.append((obj, name))
+
+    def start(self, stage: str):
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        self.starts[stage] = (time.perf_counter(), torch.cuda.memory_allocated() if self.cuda else 0)
+
+    def stop(self, stage: str, output: Any=None):
+        if self.cuda:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - self.starts[stage][0]
+        stats = self.stats.setdefault(stage, {'calls': 0, 'total_ms': 0., 'max_ms': 0., 'output_bytes': 0,
+                                              'peak_bytes': 0, 'shapes': Counter()})
+        stats['calls'] += 1
+        stats['total_ms'] += elapsed * 1e3
+        stats['max_ms'] = max(stats['max_ms'], elapsed * 1e3)
+        tensors = self.tensors(output)
+        stats['output_bytes'] += sum(tensor.element_size() * tensor.nelement() for tensor in tensors.values())
+        if self.cuda:
+            stats['peak_bytes'] = max(stats['peak_bytes'], torch.cuda.max_memory_allocated() - self.starts[stage][1])
+        shape = ', '.join(f'{key}{tuple(tensor.shape)}' for key, tensor in tensors.items())
+        if shape in stats['shapes'] or len(stats['shapes']) < self.max_shapes:
+            stats['shapes'][shape] += 1
+
+    @staticmethod
+    def tensors(output: Any, prefix: str='') -> Dict[str, torch.Tensor]:
+        """ Tensors of a (nested) output, keyed by their path """
+        if isinstance(output, torch.Tensor):
+            return {prefix: output}
+        if isinstance(output, dict):
+            items = output.items()
+        elif isinstance(output, (list, tuple)):
+            items = enumerate(output)
+        else:
+            return {}
+        tensors = {}
+        for key, value in items:
+            tensors.update(StageProfiler.tensors(value, f'{prefix}.{key}' if prefix else str(key)))
+        return tensors
+
+    def iterate(self, batches: Iterable, stage: str='batch_fetch'):
+        """ Yield from `batches`, timing the fetch of every batch """
+        iterator = iter(batches)
+        while True:
+            self.start(stage)
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.stop(stage, batch)
+            yield batch
+
+    def step(self):
+        """ Advance the traced window by one training step """
+        if self.trace is not None:
+            self.trace.step()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        return {stage: {'calls': stats['calls'], 'total_ms': stats['total_ms'],
+                        'mean_ms': stats['total_ms'] / stats['calls'], 'max_ms': stats['max_ms'],
+                        'mean_output_bytes': stats['output_bytes'] / stats['calls'],
+                        'peak_bytes': stats['peak_bytes'], 'shapes': dict(stats['shapes'].most_common())}
+                for stage, stats in self.stats.items()}
+
+    def write_summary(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class NextItemModel(nn.Module):
+    """
+    `FeaturePreprocessing → MaskSequence → TransformerBlock → NextItemPredictionTask`, returning the loss of a batch.
+    Masks precomputed by the data pipeline (`MLMBatchMasker`) are used in training when the batch carries them.
+    """
+    def __init__(self, feature_processor: FeaturePreprocessing, masking: MaskSequence, backbone: TransformerBlock,
+                       head: NextItemPredictionTask, item_feat: str='item_ids'):
+        super(NextItemModel, self).__init__()
+        self.feature_processor = feature_processor
+        self.masking = masking
+        self.backbone = backbone
+        self.head = head
+        self.item_feat = item_feat
+
+    def forward(self, batch: Dict[str, torch.Tensor], training: bool=True) -> torch.Tensor:
+        features = self.feature_processor(batch)
+        features = self.masking(features, batch[self.item_feat], training=training,
+                                masking_info=MaskingInfo.from_batch(batch) if training else None)
+        hidden = self.backbone(features, attention_mask=self.masking.attention_mask(batch[self.item_feat]))
+        return self.head.compute_loss(hidden, training=training)
+
+    def update_metrics(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """ Update the head metrics with the last item of every session of a batch """
+        features = self.masking(self.feature_processor(batch), batch[self.item_feat], training=False)
+        return self.head.calculate_metrics(
+            self.backbone(features, attention_mask=self.masking.attention_mask(batch[self.item_feat])))
+
+
+def single_thread_worker(worker_id: int):
+    """ Keep loader workers to one intra-op thread, leaving the cores to the training process """
+    torch.set_num_threads(1)
+
+
+@contextlib.contextmanager
+def intra_op_threads(num_threads: Optional[int]):
+    """ Use `num_threads` intra-op threads inside the block, restoring the previous number on exit """
+    previous = torch.get_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+class Trainer:
+    """
+    Training loop of a `NextItemModel` over a `TabularSequentialDataset`.
+    Batches come from `num_workers` loader processes, pinned and copied non-blocking on GPU hosts.
+    Gradients are accumulated over `grad_accum_steps` batches per optimizer step, the last step of an epoch
+    averaging the batches left. Every `log_every` optimizer steps the samples/sec and the mean time per step spent waiting for data, transferring,
+    in forward, backward and the optimizer are reported (the device is synchronized between stages).
+    Checkpoints are written every `checkpoint_every` optimizer steps and at the end of every epoch,
+    a checkpoint taken mid-epoch resumes after the last batch it trained on.
+    
+    Created inside an initialized process group (see `launch_local`), the model is wrapped in
+    DistributedDataParallel, every rank trains on its shard of the batches, reports count the samples
+    of all ranks and only rank 0 prints and writes checkpoints.
+    
+    Parameters
+    ----------
+    model: NextItemModel
+        Model returning the loss of a batch.
+    dataset: TabularSequentialDataset
+        Training batches, reshuffled every epoch.
+    optimizer: torch.optim.Optimizer, optional
+        Defaults to AdamW with learning rate `lr`.
+    grad_accum_steps: int
+        Number of batches per optimizer step.
+    max_grad_norm: float, optional
+        Gradient norm clipping.
+    num_workers: int
+        Number of loader processes, 0 loads in the training process.
+    num_threads: int, optional
+        Intra-op threads of the training process while fitting and evaluating, restored afterwards.
+    checkpoint_dir: str, optional
+        Directory of the checkpoints, none are written without it.
+    seed: int
+        Seed of the python, NumPy and torch generators at the start of training.
+    profiler: StageProfiler, optional
+        Entered profiler attached to the model to record the time of every stage, its hooks are removed
+        when its context exits. The model is not instrumented without it.
+    """
+    STAGES = ('data', 'transfer', 'forward', 'backward', 'optimizer')
+
+    def __init__(self, model: NextItemModel, dataset: TabularSequentialDataset,
+                       optimizer: Optional[torch.optim.Optimizer]=None, lr: float=1e-3,
+                       grad_accum_steps: int=1, max_grad_norm: Optional[float]=None,
+                       num_workers: int=4, prefetch_factor: int=2, num_threads: Optional[int]=None,
+                       checkpoint_dir: Optional[str]=None, checkpoint_every: int=500, log_every: int=50,
+                       seed: int=0, profiler: Optional[StageProfiler]=None, device: torch.device=device):
+        self.module = model.to(device)
+        self.profiler = profiler.attach(self.module) if profiler is not None else None
+        self.dataset = dataset
+        self.distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = torch.distributed.get_rank() if self.distributed else 0
+        self.world_size = torch.distributed.get_world_size() if self.distributed else 1
+        self.model = self.module
+        if self.distributed:
+            dataset.shard(self.rank, self.world_size)
+            # the XLNet word embedding and mask_emb are not used with inputs_embeds
+            self.model = nn.parallel.DistributedDataParallel(self.module, find_unused_parameters=True)
+        self.optimizer = optimizer or torch.optim.AdamW(self.model.parameters(), lr=lr)
+        self.grad_accum_steps = grad_accum_steps
+        self.max_grad_norm = max_grad_norm
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.log_every = log_every
+        self.seed = seed
+        self.device = device
+        self.step = 0
+        self.epoch = 0
+        self.samples_seen = 0
+        # batches of the current epoch already trained on
+        self.batch = 0
+        self.history = []
+        self.num_threads = num_threads
+
+    def seed_everything(self):
+        rd.seed(self.seed)
+        np.random.seed(self.seed)
+        torch.manual_seed(self.seed)
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def loader(self, start: int=0) -> DataLoader:
+        """ Batches of the current epoch from batch `start` on, reshuffled when the epoch starts """
+        self.dataset.set_epoch(self.epoch)
+        if start == 0:
+            self.dataset.shuffle()
+        return self.dataset.loader(num_workers=self.num_workers, prefetch_factor=self.prefetch_factor,
+                                   worker_init_fn=single_thread_worker, start=start)
+
+    def optimizer_step(self):
+        if self.max_grad_norm is not None:
+            nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.step += 1
+
+    def train_epoch(self):
+        self.model.train()
+        self.optimizer.zero_grad(set_to_none=True)
+        timings = dict.fromkeys(self.STAGES, 0.)
+        # a resumed epoch starts after the batches of its checkpoint, in the shuffled order of the checkpoint
+        num_samples, losses, num_batches = 0, [], self.batch
+        epoch_batches = len(self.dataset)
+        window_start = clock = time.perf_counter()
+
+        def lap(stage: str):
+            nonlocal clock
+            self.synchronize()
+            now = time.perf_counter()
+            timings[stage] += now - clock
+            clock = now
+
+        batches = self.loader(start=self.batch)
+        for batch in self.profiler.iterate(batches) if self.profiler else batches:
+            lap('data')
+            batch = batch_to_device(batch, self.device)
+            lap('transfer')
+            num_batches += 1
+            self.batch = num_batches
+            # the last group of an epoch may be shorter, its loss is averaged over the batches it has
+            group_start = (num_batches - 1) // self.grad_accum_steps * self.grad_accum_steps
+            group_size = min(self.grad_accum_steps, epoch_batches - group_start)
+            last_of_group = num_batches - group_start == group_size
+            # gradients are only all-reduced on the last batch of an optimizer step
+            accumulating = self.distributed and not last_of_group
+            with self.model.no_sync() if accumulating else contextlib.nullcontext():
+                loss = self.model(batch) / group_size
+                lap('forward')
+                loss.backward()
+            lap('backward')
+            if self.profiler:
+                self.profiler.step()
+            losses.append(loss.item() * group_size)
+            num_samples += batch[self.module.item_feat].shape[0]
+            self.samples_seen += batch[self.module.item_feat].shape[0]
+            if not last_of_group:
+                continue
+            self.optimizer_step()
+            lap('optimizer')
+            if self.step % self.log_every == 0:
+                self.report(timings, num_samples, losses, time.perf_counter() - window_start)
+                timings = dict.fromkeys(self.STAGES, 0.)
+                num_samples, losses = 0, []
+                window_start = clock = time.perf_counter()
+            if self.checkpoint_dir and self.step % self.checkpoint_every == 0:
+                self.save_checkpoint()
+                clock = time.perf_counter()
+
+        if losses:
+            self.report(timings, num_samples, losses, time.perf_counter() - window_start)
+        self.batch = 0
+
+    def report(self, timings: Dict[str, float], num_samples: int, losses: List[float], elapsed: float):
+        num_steps = max(1, m.ceil(len(losses) / self.grad_accum_steps))
+        if self.distributed:
+            totals = torch.tensor([num_samples, float(np.sum(losses)), len(losses)], dtype=torch.float64)
+            torch.distributed.all_reduce(totals)
+            num_samples, losses = int(totals[0]), [float(totals[1] / totals[2])]
+        entry = {'epoch': self.epoch, 'step': self.step, 'loss': float(np.mean(losses)),
+                 'samples/s': num_samples / elapsed,
+                 **{f'{stage} ms': timings[stage] / num_steps * 1e3 for stage in self.STAGES}}
+        self.history.append(entry)
+        if self.rank == 0:
+            print(' | '.join(f'{key} {value:.4g}' if isinstance(value, float) else f'{key} {value}'
+                             for key, value in entry.items()))
+
+    def fit(self, num_epochs: int) -> pd.DataFrame:
+        """ Train until `num_epochs` epochs are done, returning the reports """
+        if self.step == 0:
+            self.seed_everything()
+        with intra_op_threads(self.num_threads):
+            while self.epoch < num_epochs:
+                self.train_epoch()
+                self.epoch += 1
+                if self.checkpoint_dir:
+                    self.save_checkpoint()
+        return pd.DataFrame(self.history)
+
+    def evaluate(self, dataset: Optional[TabularSequentialDataset]=None) -> Dict[str, torch.Tensor]:
+        """
+        Ranking metrics of the last item of every session, synchronized over the ranks.
+        Ranks evaluate uneven shards covering every batch, their metric sums and row counts are
+        summed by torchmetrics in `compute`.
+        """
+        dataset = dataset or self.dataset
+        if self.distributed:
+            dataset.shard(self.rank, self.world_size, drop_uneven=False)
+        self.module.eval()
+        self.module.head.evaluator.reset()
+        try:
+            batches = dataset.loader(num_workers=self.num_workers, prefetch_factor=self.prefetch_factor,
+                                     worker_init_fn=single_thread_worker)
+            with torch.no_grad(), intra_op_threads(self.num_threads):
+                for batch in self.profiler.iterate(batches) if self.profiler else batches:
+                    self.module.update_metrics(batch_to_device(batch, self.device))
+        finally:
+            if self.distributed:
+                dataset.shard(self.rank, self.world_size)
+        return self.module.head.compute_metrics()
+
+    def save_checkpoint(self, path: Optional[str]=None) -> Optional[str]:
+        """
+        Model, optimizer, progress and generator states, written by rank 0 only.
+        A checkpoint taken mid-epoch also holds the batch order of the epoch and the number of
+        batches trained on, which are skipped on resume.
+        """
+        if self.rank != 0:
+            return None
+        path = path or os.path.join(self.checkpoint_dir, f'step_{self.step:08d}.pt')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        torch.save({'model': self.module.state_dict(), 'optimizer': self.optimizer.state_dict(),
+                    'step': self.step, 'epoch': self.epoch, 'batch': self.batch, 'history': self.history,
+                    'order': self.dataset.order_state() if self.batch else None,
+                    'rng': {'python': rd.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}},
+                   path)
+        return path
+
+    def load_checkpoint(self, path: str):
+        checkpoint = torch.load(path, map_location=self.device, weights_only=False)
+        self.module.load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.step, self.epoch, self.history = checkpoint['step'], checkpoint['epoch'], checkpoint['history']
+        self.batch = checkpoint.get('batch', 0)
+        if self.batch:
+            self.dataset.load_order_state(checkpoint['order'])
+        rd.setstate(checkpoint['rng']['python'])
+        np.random.set_state(checkpoint['rng']['numpy'])
+        torch.set_rng_state(checkpoint['rng']['torch'].cpu())
+
+def distributed_worker(rank: int, world_size: int, fn, args: tuple, port: int, num_threads: int):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(num_threads)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def launch_local(fn, world_size: int, *args, port: int=29500, num_threads: Optional[int]=None):
+    """
+    Run `fn(rank, world_size, *args)` in `world_size` local processes joined in a gloo process group.
+    Processes are forked, so `fn` may be a closure over objects of this session; the cores are split
+    between them unless `num_threads` is given.
+    """
+    num_threads = num_threads or max(1, (os.cpu_count() or 1) // world_size)
+    torch.multiprocessing.start_processes(distributed_worker, args=(world_size, fn, args, port, num_threads),
+                                          nprocs=world_size, join=True, start_method='fork')
+
+
+def benchmark_ddp_scaling(build_trainer, world_sizes: Iterable[int]=(1, 2, 4), num_epochs: int=1,
+                          port: int=29500) -> pd.DataFrame:
+    """
+    Train with `build_trainer()` (called in every process) on 1 to N local processes and report the
+    samples/s of all ranks together and the scaling efficiency against the first world size.
+    The efficiency only says something about scaling when every process has a core of its own:
+    `cores` is reported next to it, and a row with more processes than cores measures contention.
+    """
+    results = torch.multiprocessing.get_context('fork').SimpleQueue()
+
+    def run(rank: int, world_size: int):
+        trainer = build_trainer()
+        torch.distributed.barrier()
+        start = time.perf_counter()
+        trainer.fit(num_epochs)
+        samples = torch.tensor([trainer.samples_seen], dtype=torch.float64)
+        torch.distributed.all_reduce(samples)
+        if rank == 0:
+            results.put((world_size, float(samples) / (time.perf_counter() - start)))
+
+    throughputs = {}
+    for offset, world_size in enumerate(world_sizes):
+        launch_local(run, world_size, port=port + offset)
+        size, throughput = results.get()
+        throughputs[size] = throughput
+    base_size = min(throughputs)
+    return pd.DataFrame([{'processes': size, 'cores': os.cpu_count(), 'samples/s': throughput,
+                          'efficiency': throughput / (throughputs[base_size] / base_size * size)}
+                         for size, throughput in throughputs.items()])
+
+"""#Benchmarks"""
+
+import platform
+import subprocess
+
+def synthetic_sessions(num_sessions: int=10_000, max_seq_len: int=20, mean_seq_len: float=5.,
+                       vocab_size: int=50_000, num_users: Optional[int]=None, seed: int=0,
+                       cat_feats: list=cat_feats, num_feats: list=num_feats):
+    """
+    Random sessions with the features of `cat_feats` and `num_feats`, indexed by
+    `(user_id, user_session, session_initial_timestamp)` like the prepared `df`. Lengths are geometric with mean `mean_seq_len`, cut at `max_seq_len`,
+    and item ids are Zipf distributed over `vocab_size` items.
+    
+    Returns
+    -------
+    Tuple[pd.DataFrame, dict, dict]
+        encoded sessions, schema and vocabularies as built for the real data
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.minimum(rng.geometric(1 / mean_seq_len, num_sessions), max_seq_len)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    num_events = int(offsets[-1])
+    items = (rng.zipf(1.2, num_events) - 1) % vocab_size + 1
+    weekday = np.repeat(rng.integers(0, 7, num_sessions), lengths) * 2 * np.pi / 7
+    values = {'item_ids': items,
+              'brand_ids': items % 1_000 + 1,
+              'category_ids': items % 300 + 1_000,
+              'session_actions': rng.integers(1, 5, num_events),
+              'prices': np.round(rng.lognormal(3., 1., num_events), 2),
+              'relative_prices': rng.normal(0., 1., num_events),
+              'session_weekday_sin': np.sin(weekday),
+              'session_weekday_cos': np.cos(weekday),
+              'session_recency': rng.uniform(0., 1., num_events)}
+    frame = pd.DataFrame({'user_id': rng.integers(0, num_users or max(1, num_sessions // 3), num_sessions),
+                          'user_session': np.arange(num_sessions),
+                          'session_initial_timestamp': rng.integers(0, 7 * 86_400, num_sessions)})
+    for feat in cat_feats + num_feats:
+        frame[feat] = ragged_to_cells(values[feat], offsets)
+    frame.set_index(keys=['user_id', 'user_session', 'session_initial_timestamp'], inplace=True)
+
+    builder = SchemaBuilder(cat_feats, num_feats, encoded_feats=['category_ids'],
+                            item_feats={'item_ids': {'min_count': 1, 'num_hash_buckets': 0}})
+    builder.update_frame(frame)
+    schema, vocabularies = builder.build()
+    return apply_schema(frame, schema, vocabularies), schema, vocabularies
+
+
+def time_stage(fn, steps: int=20, warmup: int=3, setup=None) -> Dict[str, float]:
+    """
+    Wall-time statistics in ms of `fn()`, or of `fn(setup())` with the setup left out of the timing.
+    The device is synchronized around every call.
+    """
+    timings = []
+    for step in range(warmup + steps):
+        args = (setup(),) if setup is not None else ()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn(*args)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if step >= warmup:
+            timings.append((time.perf_counter() - start) * 1e3)
+    timings = np.array(timings)
+    return {'mean_ms': float(timings.mean()), 'median_ms': float(np.median(timings)),
+            'min_ms': float(timings.min()), 'std_ms': float(timings.std()), 'steps': steps}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(num_sessions: int=10_000, max_seq_len: int=20, mean_seq_len: float=5.,
+                   vocab_size: int=50_000, batch_size: int=256, hidden_dim: int=64, n_head: int=8,
+                   n_layer: int=2, mlm_probability: float=0.3, steps: int=20, warmup: int=3, seed: int=0,
+                   output_path: Optional[str]=None, label: Optional[str]=None,
+                   device: torch.device=device) -> Dict[str, Any]:
+    """
+    Time every stage of the model on `synthetic_sessions`, so runs need no data and can be compared
+    between commits with `compare_benchmarks`.
+    
+    The stages are the padding of the sessions into a `PaddedTensorStore`, the fetch of a batch,
+    `FeaturePreprocessing`, `MaskedLanguageModeling`, the `TransformerBlock` forward and backward,
+    the prediction head loss and the update of the ranking metrics, all on batches of `batch_size` sessions.
+    
+    Parameters
+    ----------
+    output_path: str, optional
+        JSON file the results are written to.
+    label: str, optional
+        Name of the run, stored with the git revision, the versions and the configuration.
+    
+    Returns
+    -------
+    Dict[str, Any]
+        `meta`, `config` and the timing statistics of every stage in `stages`
+    """
+    config = {'num_sessions': num_sessions, 'max_seq_len': max_seq_len, 'mean_seq_len': mean_seq_len,
+              'vocab_size': vocab_size, 'batch_size': batch_size, 'hidden_dim': hidden_dim, 'n_head': n_head,
+              'n_layer': n_layer, 'mlm_probability': mlm_probability, 'steps': steps, 'warmup': warmup, 'seed': seed}
+    torch.manual_seed(seed)
+    frame, schema, _ = synthetic_sessions(num_sessions, max_seq_len, mean_seq_len, vocab_size, seed=seed)
+    stages = {}
+
+    stages['padding'] = time_stage(lambda: PaddedTensorStore.from_frame(frame, schema, max_seq_len),
+                                   steps=max(1, steps // 10), warmup=1)
+    data = TabularSequentialDataset(frame, schema, max_seq_len=max_seq_len, batch_size=batch_size, device=device)
+    batch_ids = iter(range(10 ** 9))
+    stages['batch_fetch'] = time_stage(lambda: data[next(batch_ids) % len(data)], steps, warmup)
+    batch = data[0]
+
+    features = FeaturePreprocessing(schema, hidden_dim=hidden_dim).to(device)
+    masking = MaskedLanguageModeling(hidden_size=hidden_dim, padding_idx=0, mlm_probability=mlm_probability).to(device)
+    backbone = TransformerBlock(XLNetConfig.build(d_model=hidden_dim, n_head=n_head, n_layer=n_layer),
+                                masking=masking).to(device)
+    head = NextItemPredictionTask(weight_tying=True,
+                                  metrics=[NDCGAt(top_ks=[10, 20], labels_onehot=True),
+                                           RecallAt(top_ks=[10, 20], labels_onehot=True)])
+    head.build(input_size=[batch_size, max_seq_len, hidden_dim], masking=masking,
+               embedding_block=features.embedding['item_ids'])
+    head.to(device)
+
+    stages['feature_preprocessing'] = time_stage(lambda: features(batch), steps, warmup)
+    embedded = features(batch).detach()
+    stages['masking'] = time_stage(lambda: masking(embedded, batch['item_ids'], training=True), steps, warmup)
+    masked = masking(embedded, batch['item_ids'], training=True).detach().requires_grad_()
+    attention_mask = masking.attention_mask(batch['item_ids'])
+    stages['backbone_forward'] = time_stage(lambda: backbone(masked, attention_mask=attention_mask), steps, warmup)
+    stages['backbone_backward'] = time_stage(lambda loss: loss.backward(), steps, warmup,
+                                             setup=lambda: backbone(masked, attention_mask=attention_mask).sum())
+    hidden = backbone(masked, attention_mask=attention_mask).detach()
+    stages['prediction_head'] = time_stage(lambda loss: loss.backward(), steps, warmup,
+                                           setup=lambda: head.compute_loss(hidden.requires_grad_()))
+    with torch.no_grad():
+        scores, targets = head.masked_inputs(hidden)
+        scores = head.predict_block(scores)
+    stages['ranking_metrics'] = time_stage(lambda: head.evaluator.update(scores, targets), steps, warmup)
+    for stage, stats in stages.items():
+        if stage != 'padding':
+            stats['sessions/s'] = batch_size / stats['median_ms'] * 1e3
+
+    results = {'meta': {'label': label, 'revision': git_revision(), 'date': datetime.now().isoformat(),
+                        'torch': torch.__version__, 'python': platform.python_version(),
+                        'device': str(device), 'num_threads': torch.get_num_threads()},
+               'config': config, 'stages': stages}
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compare_benchmarks(baseline: Union[str, dict], candidate: Union[str, dict], tolerance: float=0.1) -> pd.DataFrame:
+    """
+    Median time of every stage in two `run_benchmarks` results (or their JSON files), flagging the stages
+    more than `tolerance` slower in `candidate`.
+    """
+    runs = []
+    for run in (baseline, candidate):
+        if isinstance(run, str):
+            with open(run) as f:
+                run = json.load(f)
+        runs.append(run)
+    if runs[0]['config'] != runs[1]['config']:
+        warnings.warn("benchmarks were run with different configurations")
+    comparison = pd.DataFrame({'baseline_ms': {stage: stats['median_ms'] for stage, stats in runs[0]['stages'].items()},
+                               'candidate_ms': {stage: stats['median_ms'] for stage, stats in runs[1]['stages'].items()}})
+    comparison['ratio'] = comparison.candidate_ms / comparison.baseline_ms
+    comparison['regression'] = comparison.ratio > 1 + tolerance
+    return comparison